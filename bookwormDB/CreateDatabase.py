@@ -5,8 +5,12 @@ import MySQLdb
 import re
 import json
 import os
+import shutil
+import tempfile
+import threading
 from .variableSet import variableSet
 from .variableSet import splitMySQLcode
+from .variableSet import run_on_connections
 from bookwormDB.configuration import Configfile
 from configparser import NoOptionError
 import logging
@@ -24,6 +28,328 @@ warnings.filterwarnings("ignore", "Table 'mysql.table_stats' doesn't exist")
 warnings.filterwarnings("ignore", "Data truncated for column .*")
 warnings.filterwarnings("ignore", "Incorrect integer value.*")
 
+def max_bookid():
+    """
+    The highest bookid assigned so far, from the bookid table.
+    """
+    import sqlite3
+    try:
+        conn = sqlite3.connect("file:.bookworm/metadata/textids.sqlite?mode=ro", uri=True)
+        maximum = conn.execute("SELECT MAX(ID) FROM keys").fetchone()[0]
+        conn.close()
+    except sqlite3.Error:
+        maximum = None
+    if maximum is None:
+        # The largest bookid a MEDIUMINT UNSIGNED can hold.
+        maximum = 16777215
+    return maximum
+
+def partition_sql(partition_by, partitions, hash_column="wordid"):
+    """
+    The PARTITION BY clause for a count table: either by a hash of its
+    (first) wordid, so that a query on a few words only reads a few
+    partitions, or by ranges of bookids of about equal size.
+    """
+    if partition_by is None:
+        return ""
+    if partition_by == "hash":
+        return " PARTITION BY HASH(%s) PARTITIONS %d" % (hash_column, partitions)
+    if partition_by == "range":
+        step = max_bookid() // partitions + 1
+        ranges = ["PARTITION p%d VALUES LESS THAN (%d)" % (i, step * (i + 1)) for i in range(partitions - 1)]
+        ranges.append("PARTITION p%d VALUES LESS THAN MAXVALUE" % (partitions - 1))
+        return " PARTITION BY RANGE(bookid) (" + ", ".join(ranges) + ")"
+    raise ValueError("Count tables can only be partitioned by 'hash' or 'range', not '%s'" % partition_by)
+
+def partitions_supported(version, engine):
+    """
+    Whether a server reporting `version` (as from SELECT VERSION()) can
+    partition tables of `engine` natively. MySQL 8.0 only partitions
+    InnoDB (and NDB) tables; MariaDB and older MySQL partition MyISAM too.
+    """
+    if "mariadb" in version.lower() or engine.upper() not in ("MYISAM", "MERGE"):
+        return True
+    major = re.match(r"\d+", version)
+    return major is not None and int(major.group()) < 8
+
+def check_partitioning(db):
+    """
+    Fail with a clear message, before any tables are dropped, if the
+    count tables can't have native partitions on this server.
+    """
+    version, engine = db.query("SELECT VERSION(), @@default_storage_engine").fetchall()[0]
+    if not partitions_supported(version, engine):
+        raise ValueError("MySQL %s can't partition %s tables, so --partition-by only works on "
+                         "MariaDB or MySQL 5.7 and earlier: use --jobs to load the unigrams into "
+                         "a MERGE table of separate ones instead" % (version, engine))
+
+# The largest multi-row INSERT to send when LOAD DATA LOCAL isn't allowed.
+INSERT_STATEMENT_BYTES = 4 * 1024 * 1024
+
+# The errors for LOAD DATA LOCAL being turned off: on the server (1148, or
+# 3948 from MySQL 8), or in the client library (2068).
+LOCAL_INFILE_REFUSED = (1148, 2068, 3948)
+
+def local_infile_refused(error):
+    return len(error.args) > 0 and error.args[0] in LOCAL_INFILE_REFUSED
+
+integer_row = re.compile(r"\d+(\t\d+)*")
+
+# Rows per batch read from HDF5 or Parquet count files.
+COLUMNAR_BATCH_ROWS = 2000000
+
+def insert_rows(db, lines, tablename, columns, source=""):
+    """
+    Stream lines of tab-separated integers into `tablename` as multi-row
+    INSERT statements, each within the server's max_allowed_packet, so
+    that only one statement is ever in memory.
+    """
+    packet = db.query("SELECT @@max_allowed_packet").fetchall()[0][0]
+    limit = min(INSERT_STATEMENT_BYTES, int(packet) - 1024)
+    prefix = "INSERT INTO %s (%s) VALUES " % (tablename, ",".join(columns))
+    rows = []
+    size = len(prefix)
+    n = 0
+    for line in lines:
+        line = line.rstrip("\n")
+        if not integer_row.fullmatch(line):
+            if line == "":
+                continue
+            raise ValueError("Unexpected line in %s: %s" % (source, line[:100]))
+        row = "(" + line.replace("\t", ",") + ")"
+        if len(rows) > 0 and size + len(row) + 1 > limit:
+            db.query(prefix + ",".join(rows))
+            rows = []
+            size = len(prefix)
+        rows.append(row)
+        size += len(row) + 1
+        n += 1
+    if len(rows) > 0:
+        db.query(prefix + ",".join(rows))
+    return n
+
+def load_counts(db, path, tablename, columns):
+    """
+    Load a file of counts with LOAD DATA LOCAL INFILE; where the server or
+    client won't allow that, fall back to streaming INSERTs, and don't
+    try LOAD DATA over that connection again. Returns the number of rows.
+
+    Any other error is raised: LOAD DATA may have loaded some of the rows,
+    so neither it nor the INSERTs can safely be tried again.
+    """
+    if getattr(db, "local_infile", True):
+        try:
+            return db.query("LOAD DATA LOCAL INFILE '" + path + "' INTO TABLE " + tablename + " CHARACTER SET utf8 (" + ",".join(columns) + ");",
+                            retry=False).rowcount
+        except Exception as e:
+            if not local_infile_refused(e):
+                raise
+            logging.warning("LOAD DATA LOCAL INFILE isn't allowed: falling back on batched inserts, which are slower.")
+            db.local_infile = False
+    with open(path) as fin:
+        return insert_rows(db, fin, tablename, columns, path)
+
+def columnar_file(filename):
+    return filename.endswith(".h5") or filename.endswith(".parquet")
+
+def columnar_batches(path, key, columns, batchsize=COLUMNAR_BATCH_ROWS):
+    """
+    Yield DataFrames of `columns`, a batch at a time, from the `key` table
+    (e.g. /unigrams) of an HDF5 file or from a Parquet file. Indexed
+    columns (as in a table indexed by bookid and wordid) become ordinary
+    ones.
+    """
+    import pandas as pd
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        chunks = (batch.to_pandas() for batch in
+                  pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batchsize))
+    else:
+        chunks = pd.read_hdf(path, key, mode="r", chunksize=batchsize)
+    for chunk in chunks:
+        if any([name is not None for name in chunk.index.names]):
+            chunk = chunk.reset_index()
+        if all([column in chunk.columns for column in columns]):
+            chunk = chunk[columns]
+        elif len(chunk.columns) != len(columns):
+            raise ValueError("%s should have the columns %s" % (path, ", ".join(columns)))
+        yield chunk
+
+def batch_lines(batches):
+    for batch in batches:
+        for line in batch.to_csv(sep="\t", header=False, index=False).splitlines():
+            yield line
+
+def file_bookids(path, key, columns):
+    """
+    The set of bookids (the first column) in a file of counts.
+    """
+    bookids = set()
+    if columnar_file(path):
+        for batch in columnar_batches(path, key, columns):
+            bookids.update(batch.iloc[:, 0].unique().tolist())
+    else:
+        with open(path) as fin:
+            for line in fin:
+                bookid = line.split("\t", 1)[0].strip()
+                if bookid != "":
+                    bookids.add(int(bookid))
+    return bookids
+
+def load_columnar(db, path, key, tablename, columns):
+    """
+    Load an HDF5 or Parquet file of counts without writing it out to disk
+    first: the batches are written as text into a named pipe from another
+    thread while LOAD DATA LOCAL INFILE reads from the other end. Falls
+    back, like `load_counts`, on batched INSERTs.
+    """
+    if getattr(db, "local_infile", True):
+        directory = tempfile.mkdtemp(prefix="bookworm_")
+        pipe = os.path.join(directory, "counts.fifo")
+        os.mkfifo(pipe)
+        errors = []
+        def write():
+            try:
+                with open(pipe, "w") as fout:
+                    for batch in columnar_batches(path, key, columns):
+                        batch.to_csv(fout, sep="\t", header=False, index=False)
+            except BrokenPipeError:
+                # LOAD DATA stopped reading.
+                pass
+            except Exception as e:
+                errors.append(e)
+        writer = threading.Thread(target=write)
+        writer.start()
+        refused = False
+        try:
+            # Never retried: the pipe can only be read once.
+            rows = db.query("LOAD DATA LOCAL INFILE '" + pipe + "' INTO TABLE " + tablename + " CHARACTER SET utf8 (" + ",".join(columns) + ");",
+                            retry=False).rowcount
+        except Exception as e:
+            if not local_infile_refused(e):
+                raise
+            logging.warning("LOAD DATA LOCAL INFILE isn't allowed: falling back on batched inserts, which are slower.")
+            db.local_infile = False
+            refused = True
+        finally:
+            while writer.is_alive():
+                # Open and close the reading end so the writer isn't left waiting for one.
+                os.close(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+                writer.join(0.1)
+            shutil.rmtree(directory)
+        if len(errors) > 0:
+            raise errors[0]
+        if not refused:
+            return rows
+    return insert_rows(db, batch_lines(columnar_batches(path, key, columns)), tablename, columns, path)
+
+
+class LoadManifest(object):
+    """
+    A table of every file of counts loaded into the database: its path,
+    size, modification time, table, and number of rows. A file is marked
+    as loading before it starts and as loaded once it's done, so an
+    interrupted ingest can pick up where it left off. Files are told apart
+    by size and mtime rather than by reading them all again to checksum.
+
+    MyISAM can't roll back half a file, so the rows of a file that was
+    interrupted (or failed) partway through are deleted by bookid before
+    it's loaded again. That relies on no two encoded files sharing a
+    bookid, which holds since each book's counts are written together.
+    """
+    def __init__(self, db):
+        db.query("""CREATE TABLE IF NOT EXISTS load_manifest (
+        path VARCHAR(255) NOT NULL, PRIMARY KEY (path),
+        tablename VARCHAR(64) NOT NULL,
+        size BIGINT UNSIGNED,
+        mtime BIGINT UNSIGNED,
+        rowcount BIGINT UNSIGNED,
+        status VARCHAR(16),
+        finished TIMESTAMP NULL)""")
+
+    @staticmethod
+    def signature(path):
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def forget(self, db, tablenames):
+        """
+        Clear the entries for tables that are about to be made again.
+        """
+        for tablename in tablenames:
+            db.query("DELETE FROM load_manifest WHERE tablename = %s", (tablename,))
+
+    def pending(self, db, paths, tablenames, key="unigrams", columns=["bookid", "wordid", "count"]):
+        """
+        Which of `paths` still need loading into `tablenames`. Clears out
+        the rows of any file that was interrupted partway through, and
+        refuses to go on if a loaded file has changed since. `key` and
+        `columns` are as for `load_ngram_text`, to read the bookids.
+        """
+        entries = dict()
+        for path, tablename, size, mtime, status in db.query(
+                "SELECT path, tablename, size, mtime, status FROM load_manifest").fetchall():
+            if tablename in tablenames:
+                entries[path] = (tablename, (size, mtime), status)
+        remaining = []
+        for path in paths:
+            try:
+                tablename, signature, status = entries[path]
+            except KeyError:
+                remaining.append(path)
+                continue
+            if signature != self.signature(path):
+                raise ValueError("%s has changed since it was loaded into %s: "
+                                 "load the tables again from scratch" % (path, tablename))
+            if status != "loaded":
+                logging.warning("Loading %s into %s was interrupted: removing its rows to load it again" % (path, tablename))
+                self.clear(db, path, tablename, key, columns)
+                remaining.append(path)
+        if len(remaining) < len(paths):
+            logging.info("Skipping %d files that were already loaded" % (len(paths) - len(remaining)))
+        return remaining
+
+    def clear(self, db, path, tablename, key, columns):
+        """
+        Delete whatever rows of `path` made it into `tablename`, in one pass
+        over the table (whose keys may be disabled), by joining it against
+        a temporary table of the file's bookids.
+        """
+        db.query("DROP TEMPORARY TABLE IF EXISTS interrupted_bookids")
+        db.query("CREATE TEMPORARY TABLE interrupted_bookids "
+                 "(bookid MEDIUMINT UNSIGNED NOT NULL, PRIMARY KEY (bookid))")
+        bookids = file_bookids(path, key, columns)
+        insert_rows(db, (str(bookid) for bookid in sorted(bookids)), "interrupted_bookids", ["bookid"], path)
+        rows = db.query("DELETE " + tablename + " FROM " + tablename +
+                        " JOIN interrupted_bookids USING (bookid)").rowcount
+        db.query("DROP TEMPORARY TABLE interrupted_bookids")
+        db.query("DELETE FROM load_manifest WHERE path = %s", (path,))
+        logging.info("Removed %d rows for %d books from %s" % (rows, len(bookids), tablename))
+
+    def load(self, db, path, tablename, function):
+        """
+        Run `function`, which loads `path` into `tablename` and returns the
+        number of rows (or None if it failed), with a record of it.
+        """
+        size, mtime = self.signature(path)
+        db.query("REPLACE INTO load_manifest (path, tablename, size, mtime, status) "
+                 "VALUES (%s, %s, %s, %s, 'loading')", (path, tablename, size, mtime))
+        rows = function()
+        if rows is not None:
+            db.query("UPDATE load_manifest SET status = 'loaded', rowcount = %s, finished = NOW() "
+                     "WHERE path = %s", (rows, path))
+        return rows
+
+def raise_load_failures(ngramname, failed):
+    """
+    Fail the ingest, before any keys are built, if any file didn't load.
+    They're left marked as loading in the manifest, so `--no-delete`
+    removes whatever rows they got in and loads them again.
+    """
+    if len(failed) > 0:
+        raise RuntimeError("Failed to load %s from %d files (%s): see the errors above, "
+                           "and run again with --no-delete to retry them" % (ngramname, len(failed), ", ".join(sorted(failed))))
+
 class DB(object):
     def __init__(self, dbname = None):
         if dbname == None:
@@ -78,13 +404,16 @@ class DB(object):
         logging.debug("Connecting to %s" % self.dbname)
         cursor.execute("USE %s" % self.dbname)
 
-    def query(self, sql, params = None, many_params=None):
+    def query(self, sql, params = None, many_params=None, retry=True):
         """
         If a connection times out, reboot
         the connection and starts up nicely again.
 
         many_params: If included, assume that executemany() is expected, with the sequence of parameter
                         provided.
+        retry: if False, raise the first error rather than reconnecting and
+                        running the statement again (which could, for instance,
+                        load some rows twice).
         """
         logging.debug(" -- Preparing to execute SQL code -- " + sql)
         logging.debug(" -- with params {}".format(params))        
@@ -94,9 +423,11 @@ class DB(object):
             if many_params is not None:
                 cursor.executemany(sql, many_params)
             else:
-                
-                cursor.execute(sql)
+                cursor.execute(sql, params)
         except:
+            if not retry:
+                logging.error("Query failed: \n" + sql + "\n")
+                raise
             try:
                 self.connect()
                 cursor = self.conn.cursor()
@@ -242,13 +573,36 @@ class BookwormSQLDatabase(object):
         """
         self.variableSet.loadMetadata()
 
-    def create_unigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1):
+    def create_unigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1, jobs=1,
+                                   partition_by=None, partitions=16):
+        """
+        Load the encoded unigrams into master_bookcounts.
+
+        With `jobs` above one, the counts are split into (at least) that many
+        partitions under a MERGE table, and each partition is loaded and
+        then indexed over its own connection, all at once.
+
+        Alternatively, `partition_by` ('hash' or 'range') makes a single
+        table with native MySQL partitions (see `partition_sql`).
+
+        Without `newtable`, files already in the load manifest are skipped,
+        so an interrupted ingest can be resumed (see `LoadManifest`).
+        """
         import time
         t0 = time.time()
 
         db = self.db
         ngramname = "unigrams"
         tablenameroot = "master_bookcounts"
+        if partition_by is not None:
+            check_partitioning(db)
+            if jobs > 1 or table_count > 1:
+                logging.warning("Native partitions are loaded over one connection: ignoring --jobs")
+            jobs = 1
+            table_count = 1
+        if jobs > 1:
+            table_count = max(table_count, jobs)
+        keys_enabled = False
         # If you are splitting the input into multiple tables
         # to be joined as a merge table, come up with multiple 
         # table names and we'll cycle through.
@@ -261,20 +615,20 @@ class BookwormSQLDatabase(object):
             raise
 
         grampath =  ".bookworm/texts/encoded/%s" % ngramname
-        tmpdir = "%s/tmp" % grampath
 
         if (len(grampath) == 0) or (grampath == "/"):
             logging.error("Woah! Don't set the ngram path to your system root!")
             raise
         
+        manifest = LoadManifest(db)
         if newtable:
-            if os.path.exists(tmpdir):
-                import shutil
-                shutil.rmtree(tmpdir)
-        
             logging.info("Dropping older %s table, if it exists" % ngramname)
             for tablename in tablenames:
                 db.query("DROP TABLE IF EXISTS " + tablename)
+            manifest.forget(db, tablenames)
+            if table_count > 1:
+                # An older unpartitioned table would keep the merge table from being made.
+                db.query("DROP TABLE IF EXISTS " + tablenameroot)
 
         logging.info("Making a SQL table to hold the %s" % ngramname)
         reverse_index_sql = "INDEX(bookid,wordid,count), " if reverse_index else ""
@@ -282,7 +636,7 @@ class BookwormSQLDatabase(object):
             db.query("CREATE TABLE IF NOT EXISTS " + tablename + " ("
                 "bookid MEDIUMINT UNSIGNED NOT NULL, " + reverse_index_sql +
                 "wordid MEDIUMINT UNSIGNED NOT NULL, INDEX(wordid,bookid,count), "
-                "count MEDIUMINT UNSIGNED NOT NULL);")
+                "count MEDIUMINT UNSIGNED NOT NULL)" + partition_sql(partition_by, partitions) + ";")
 
         if ingest:
             for tablename in tablenames:
@@ -291,84 +645,51 @@ class BookwormSQLDatabase(object):
             db.query("set CHARACTER SET utf8;")
             logging.info("loading data using LOAD DATA LOCAL INFILE")
             
-            files = os.listdir(grampath)
-            for i, filename in enumerate(files):
-                if filename.endswith('.txt'):
+            files = [f for f in os.listdir(grampath) if f.endswith('.txt') or columnar_file(f)]
+            files = [os.path.basename(path) for path in
+                     manifest.pending(db, [grampath + "/" + f for f in files], tablenames, ngramname)]
+            failed = []
+            if jobs > 1:
+                # Give each file, largest first, to the partition with the least data so far.
+                partitions = dict([(tablename, []) for tablename in tablenames])
+                sizes = dict([(tablename, 0) for tablename in tablenames])
+                for filename in sorted(files, key=lambda f: -os.path.getsize(grampath + "/" + f)):
+                    tablename = min(tablenames, key=lambda t: sizes[t])
+                    partitions[tablename].append(filename)
+                    sizes[tablename] += os.path.getsize(grampath + "/" + filename)
+
+                def load(tablename):
+                    def run(db):
+                        for filename in partitions[tablename]:
+                            if self.load_ngram_text(db, grampath, filename, tablename, ngramname, manifest=manifest) is None:
+                                failed.append(filename)
+                        if index and len(failed) == 0:
+                            logging.info("Enabling keys on %s" % tablename)
+                            db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+                    return run
+
+                logging.info("Loading %d partitions over %d connections" % (len(tablenames), jobs))
+                run_on_connections([(tablename, load(tablename), []) for tablename in tablenames], self.db, jobs)
+                keys_enabled = index and len(failed) == 0
+            else:
+                for i, filename in enumerate(files):
                     # With each input file, cycle through each table in tablenames
                     tablename = tablenames[i % len(tablenames)]
-                    logging.debug("Importing txt file, %s (%d/%d)" % (filename, i, len(files)))
-                    try:
-                        db.query("LOAD DATA LOCAL INFILE '" + grampath + "/" + filename + "' INTO TABLE " + tablename +" CHARACTER SET utf8 (bookid,wordid,count);")
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                       logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
-                       try:
-                            import pandas as pd
-                            df = pd.read_csv(grampath + "/" + filename, sep='\t', header=None)
-                            to_insert = df.apply(tuple, axis=1).tolist()
-                            db.query(
-                                "INSERT INTO " + tablename + " (bookid,wordid,count) "
-                                "VALUES (%s, %s, %s);""",
-                                many_params=to_insert
-                                )
-                       except KeyboardInterrupt:
-                           raise
-                       except:
-                           logging.exception("Error inserting %s from %s" % (ngramname, filename))
-                           continue
-
-                elif filename.endswith('.h5'):
-                    logging.info("Importing h5 file, %s (%d/%d)" % (filename, i, len(files)))
-                    try:
-                        # When encountering an .h5 file, this looks for ngram information
-                        # in a /#{ngramnames} table (e.g. /unigrams) and writes it out to
-                        # temporary TSV files.
-                        # Dask is used here simply because it's a dead simple way to multithread
-                        # the TSV writing and lower the overhead versus having a TSV already staged.
-                        import csv
-                        import pandas as pd
-                        try:
-                            import dask.dataframe as dd
-                        except:
-                            logging.exception("Ingesting h5 files requires dask")
-                        try:
-                            os.makedirs(tmpdir)
-                        except OSError:
-                            if not os.path.isdir(tmpdir):
-                                raise
-                        # Dask will use #{n_cores-1} threads when saving CSVs.
-                        # Ingest and key reload times are identical to txt import, so the only
-                        # additional overhead is reading the file (small effect) and writing the csv.
-                        ddf = dd.read_hdf(grampath + "/" + filename,
-                                          ngramname, mode='r', chunksize=2000000)
-                        ddf.reset_index().to_csv(tmpdir + '/tmp.*.tsv',
-                                                 index=False, sep='\t', header=False,
-                                                 quoting=csv.QUOTE_NONNUMERIC)
-                        logging.info("CSV written from H5. Time passed: %.2f s" % (time.time() - t0))
-                        for j, tmpfile in enumerate(os.listdir(tmpdir)):
-                            # With each input file, cycle through each table in tablenames
-                            tablename = tablenames[j % len(tablenames)]
-                            path = "%s/%s" % (tmpdir, tmpfile)
-                            db.query("LOAD DATA LOCAL INFILE '" + path + "' "
-                                     "INTO TABLE " + tablename + " "
-                                     "CHARACTER SET utf8 (bookid,wordid,count);")
-                            try:
-                                os.remove(path)
-                            except:
-                                pass
-                        logging.info("CSVs input. Time passed: %.2f s" % (time.time() - t0))
-                    except KeyboardInterrupt:
-                       raise
-                    except:
-                       logging.exception("Error inserting %s from %s" % (ngramname, filename))
-                       continue
-                else:
-                    continue
+                    logging.debug("Importing %s (%d/%d)" % (filename, i, len(files)))
+                    if self.load_ngram_text(db, grampath, filename, tablename, ngramname, manifest=manifest) is None:
+                        failed.append(filename)
+                logging.info("Counts loaded. Time passed: %.2f s" % (time.time() - t0))
+            raise_load_failures(ngramname, failed)
         if index:
             logging.info("Creating Unigram Indexes. Time passed: %.2f s" % (time.time() - t0))
-            for tablename in tablenames:
-                db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+            if jobs > 1:
+                def enable(tablename):
+                    return lambda db: db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+                if not keys_enabled:
+                    run_on_connections([(tablename, enable(tablename), []) for tablename in tablenames], self.db, jobs)
+            else:
+                for tablename in tablenames:
+                    db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
 
             if table_count > 1:
                 logging.info("Creating a merge table for " + ",".join(tablenames))
@@ -380,19 +701,60 @@ class BookwormSQLDatabase(object):
 
         logging.info("Unigram index created in: %.2f s" % ((time.time() - t0)))
 
-    def create_bigram_book_counts(self):
+    def load_ngram_text(self, db, grampath, filename, tablename, ngramname="unigrams",
+                        columns=["bookid", "wordid", "count"], manifest=None):
+        """
+        Load one encoded file of counts into `tablename`: either text, or
+        HDF5 or Parquet, which are streamed in without temporary files.
+        Returns the number of rows loaded, or None if it failed; with a
+        `manifest`, the load is recorded there.
+        """
+        path = grampath + "/" + filename
+        def load():
+            try:
+                if columnar_file(filename):
+                    return load_columnar(db, path, ngramname, tablename, columns)
+                else:
+                    return load_counts(db, path, tablename, columns)
+            except KeyboardInterrupt:
+                raise
+            except:
+                logging.exception("Error inserting %s from %s" % (ngramname, filename))
+        if manifest is None:
+            return load()
+        return manifest.load(db, path, tablename, load)
+
+    def create_bigram_book_counts(self, newtable=True, partition_by=None, partitions=16):
+        """
+        Load the encoded bigrams into master_bigrams, optionally with native
+        partitions by the first word or by bookid (see `partition_sql`).
+        Without `newtable`, resumes from the load manifest like the unigrams.
+        """
         db = self.db
+        grampath = ".bookworm/texts/encoded/bigrams"
+        if partition_by is not None:
+            check_partitioning(db)
+        manifest = LoadManifest(db)
         logging.info("Making a SQL table to hold the bigram counts")
-        db.query("""DROP TABLE IF EXISTS master_bigrams""")
-        db.query("""CREATE TABLE master_bigrams (
+        if newtable:
+            db.query("""DROP TABLE IF EXISTS master_bigrams""")
+            manifest.forget(db, ["master_bigrams"])
+        db.query("""CREATE TABLE IF NOT EXISTS master_bigrams (
         bookid MEDIUMINT UNSIGNED NOT NULL,
         word1 MEDIUMINT UNSIGNED NOT NULL, INDEX (word1,word2,bookid,count),
         word2 MEDIUMINT UNSIGNED NOT NULL,
-        count MEDIUMINT UNSIGNED NOT NULL);""")
+        count MEDIUMINT UNSIGNED NOT NULL)""" + partition_sql(partition_by, partitions, "word1") + ";")
         db.query("ALTER TABLE master_bigrams DISABLE KEYS")
         logging.info("loading data using LOAD DATA LOCAL INFILE")
-        for filename in os.listdir(".bookworm/texts/encoded/bigrams"):
-            db.query("LOAD DATA LOCAL INFILE '.bookworm/texts/encoded/bigrams/"+filename+"' INTO TABLE master_bigrams CHARACTER SET utf8 (bookid,word1,word2,count);")
+        files = [grampath + "/" + f for f in os.listdir(grampath) if f.endswith(".txt") or columnar_file(f)]
+        failed = []
+        for path in manifest.pending(db, files, ["master_bigrams"], "bigrams",
+                                     ["bookid", "word1", "word2", "count"]):
+            filename = os.path.basename(path)
+            if self.load_ngram_text(db, grampath, filename, "master_bigrams", "bigrams",
+                                    ["bookid", "word1", "word2", "count"], manifest=manifest) is None:
+                failed.append(filename)
+        raise_load_failures("bigrams", failed)
 
         logging.info("Creating bigram indexes")
         db.query("ALTER TABLE master_bigrams ENABLE KEYS")
@@ -3,13 +3,15 @@ from datetime import date
 import datetime
 import dateutil.parser
 import json
+import numpy as np
+import re
 import sys
 import os
 import logging
-from multiprocessing import Queue, Process
-from queue import Empty
-from .multiprocessingHelp import mp_stats, running_processes
-import time
+from multiprocessing import Pool
+from .multiprocessingHelp import mp_stats
+from .sharded_input import shards, read_shard
+from functools import lru_cache
 
 
 defaultDate = datetime.datetime(datetime.MINYEAR, 1, 1)
@@ -18,6 +20,119 @@ def DaysSinceZero(dateobj):
     #Zero isn't a date, which python knows but MySQL and javascript don't.
     return (dateobj - date(1,1,1)).days + 366
 
+# Strings that need no help from dateutil: '1850-03-05', '1850-03', and '1850'.
+iso_date = re.compile(r"(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?$")
+
+# Distinct date strings to remember the derived fields of, per field.
+DATE_CACHE_SIZE = 100000
+
+# Roughly how much of jsoncatalog.txt each catalog worker parses at a time.
+CATALOG_CHUNK_BYTES = 16 * 1024 * 1024
+
+def parse_date(string):
+    """
+    Parse a date string as `dateutil.parser.parse` would with `defaultDate`,
+    but without calling it for plain ISO dates and bare years.
+    """
+    match = iso_date.match(string)
+    if match is not None:
+        year, month, day = match.groups()
+        try:
+            return datetime.datetime(int(year), int(month or 1), int(day or 1))
+        except ValueError:
+            # Let dateutil decide what to make of it.
+            pass
+    return dateutil.parser.parse(string, default = defaultDate)
+
+def derive_date_fields(field, time):
+    """
+    Return a dict of all the fields derived from a parsed date,
+    as described by `field["derived"]`.
+    """
+    name = field["field"]
+    intent = [time.year, time.month, time.day]
+    output = dict()
+    for derive in field["derived"]:
+        try:
+            if "aggregate" in derive:
+                if derive["resolution"] == 'day' and \
+                        derive["aggregate"] == "year":
+                    dt = date(intent[0], intent[1], intent[2])
+                    output["%s_day_year" % name] = dt.timetuple().tm_yday
+                elif derive["resolution"] == 'day' and \
+                        derive["aggregate"] == "month":
+                    output["%s_day_month" % name] = intent[2]
+                elif derive["resolution"] == 'day' and \
+                        derive["aggregate"] == "week":
+                    dt = date(intent[0], intent[1], intent[2])
+                    # Python and javascript handle weekdays differently:
+                    # Like JS, we want to begin on Sunday with zero
+                    output["%s_day_week" % name] = (dt.weekday() + 1) % 7
+                elif derive["resolution"] == 'month' and \
+                        derive["aggregate"] == "year":
+                    dt = date(1,intent[1],1)
+                    output["%s_month_year" % name] = dt.timetuple().tm_yday
+                elif derive["resolution"] == 'week' and \
+                        derive["aggregate"] == "year":
+                    dt = date(intent[0], intent[1], intent[2])
+                    output["%s_week_year" % name] = int(dt.timetuple().tm_yday/7)*7
+                elif derive["resolution"] == 'hour' and \
+                        derive["aggregate"] == "day":
+                    output["%s_hour_day" % name] = time.hour
+                elif derive["resolution"] == 'minute' and \
+                        derive["aggregate"] == "day":
+                    output["%s_minute_day" % name] = time.hour*60 + time.minute
+                else:
+                    logging.warning('Problem with aggregate resolution.')
+                    continue
+            else:
+                if derive["resolution"] == 'year':
+                    output["%s_year" % name] = intent[0]
+                elif derive["resolution"] == 'month':
+                    try:
+                        dt = date(intent[0], intent[1], 1)
+                        output["%s_month" % name] = DaysSinceZero(dt)
+                    except:
+                        logging.warning("Problem with date fields\n")
+                        pass
+                elif derive['resolution'] == 'week':
+                    dt = date(intent[0], intent[1], intent[2])
+                    inttime = DaysSinceZero(dt)
+                    #Not starting on Sunday or anything funky like that. Actually, I don't know what we're starting on. Adding an integer here would fix that.
+                    output["%s_week" % name] = int(inttime/7)*7
+                elif derive['resolution'] == 'day':
+                    dt = date(intent[0], intent[1], intent[2])
+                    output["%s_day" % name] = DaysSinceZero(dt)
+                else:
+                    logging.warning('Resolution %s currently not supported.' % (derive['resolution']))
+                    continue
+        except ValueError:
+            # One of out a million Times articles threw this with
+            # a year of like 111,203. It's not clear how best to
+            # handle this.
+            logging.warning("ERROR: %s " % time +
+                            "did not convert to proper date. Moving on...")
+        except Exception as e:
+            logging.warning('*'*50)
+            logging.warning('ERROR: %s\nINFO: %s\n' % (str(e), e.__doc__))
+            logging.warning('*'*50)
+    return output
+
+def date_deriver(field):
+    """
+    Return a function from a date string to its derived fields (or None if
+    it isn't a date). A catalog has far fewer distinct dates than rows, so
+    each string is parsed and derived only once while it stays in the cache.
+    """
+    @lru_cache(maxsize = DATE_CACHE_SIZE)
+    def derive(string):
+        try:
+            time = parse_date(string)
+        except Exception:
+            return None
+        return derive_date_fields(field, time)
+    return derive
+
 def ParseFieldDescs(write = False):
     f = open('field_descriptions.json', 'r')
     try:
@@ -59,31 +174,22 @@ def ParseFieldDescs(write = False):
         
     return (fields_to_derive, fields)
 
-def parse_json_catalog(line_queue, processes, modulo):
-    fields_to_derive, fields = ParseFieldDescs(write = False)
-    
-    if os.path.exists("jsoncatalog.txt"):
-        mode = "json"
-        fin = open("jsoncatalog.txt")
-        
-    if os.path.exists("catalog.csv"):
-        mode = "csv"
-        import csv
-        fin  = csv.DictReader("catalog.csv")
-        
-    for i, line in enumerate(fin):
-        if i % processes != modulo:
-            continue
-        
+def parse_json_catalog(lines, fields_to_derive, fields, derivers):
+    """
+    Yield (filename, json line) for each line of a json catalog, with
+    the derived date fields filled in.
+
+    derivers: a dict from each field in fields_to_derive to its `date_deriver`.
+    """
+    for line in lines:
         for char in ['\t', '\n']:
             line = line.replace(char, '')
 
-        if mode == "json":
-            try:
-                line = json.loads(line)
-            except:
-                logging.warn("Couldn't parse catalog line {}".format(line))
-                continue
+        try:
+            line = json.loads(line)
+        except:
+            logging.warn("Couldn't parse catalog line {}".format(line))
+            continue
             
         for field in fields:
             # Smash together misidentified lists
@@ -94,176 +200,248 @@ def parse_json_catalog(line_queue, processes, modulo):
                 pass
         
         for field in fields_to_derive:
-            
-            """
-            Using fields_to_derive as a shorthand for dates--this may break 
-            if we get more ambitious about derived fields,
-            but this whole metadata-parsing code needs to be refactored anyway.
-
-            Note: this code is inefficient--it parses the same date multiple times. 
-            We should be parsing the date once and pulling 
-            derived fields out of that one parsing.
-            """
-            
+            # Using fields_to_derive as a shorthand for dates--this may break
+            # if we get more ambitious about derived fields.
             try:
-                if line[field["field"]]=="":
-                    # Use blankness as a proxy for unknown
-                    continue
-
-                time = dateutil.parser.parse(line[field["field"]],default = defaultDate)
-                intent = [time.year,time.month,time.day]
-                content = [str(item) for item in intent]
-                
-                pass
-            except:
-                """
-                Fall back to parsing as strings
-                """
-                try:
-                    datem = line[field["field"]].split("T")[0]
-                    content = datem.split('-')
-                    intent = [int(item) for item in content]
-                except KeyError:
-                    #It's OK not to have an entry for a time field
-                    continue
-                except ValueError:
-                    # Thrown if fields are empty on taking the int value: treat as junk
-                    continue
-                except AttributeError:
-                    """
-                    Happens if it's an integer, which is a forgiveable way
-                    to enter a year:
-                    """
-                    content = [str(line[field['field']])]
-                    intent = [line[field['field']]]
-            else:
-                for derive in field["derived"]:
-                    try:
-                        if "aggregate" in derive:
-                            if derive["resolution"] == 'day' and \
-                                    derive["aggregate"] == "year":
-                                k = "%s_day_year" % field["field"]
-                                dt = date(intent[0], intent[1], intent[2])
-                                line[k] = dt.timetuple().tm_yday
-                            elif derive["resolution"] == 'day' and \
-                                    derive["aggregate"] == "month":
-                                k = "%s_day_month" % field["field"]
-                                line[k] = intent[2]
-                            elif derive["resolution"] == 'day' and \
-                                    derive["aggregate"] == "week":
-                                k = "%s_day_month" % field["field"]
-                                dt = date(intent[0], intent[1], intent[2])
-                                # Python and javascript handle weekdays differently:
-                                # Like JS, we want to begin on Sunday with zero
-                                line[k] = dt.weekday() + 1
-                                if (line[k]) == 7:
-                                    line[k] = 0
-                            elif derive["resolution"] == 'month' and \
-                                    derive["aggregate"] == "year":
-                                k = "%s_month_year" % field["field"]
-                                dt = date(1,intent[1],1)
-                                line[k] = dt.timetuple().tm_yday
-                            elif derive["resolution"] == 'week' and \
-                                    derive["aggregate"] == "year":
-                                dt = date(intent[0], intent[1], intent[2])
-                                k = "%s_week_year" % field["field"]
-                                line[k] = int(dt.timetuple().tm_yday/7)*7
-                            elif derive["resolution"] == 'hour' and \
-                                    derive["aggregate"] == "day":
-                                k = "%s_hour_day" % field["field"]
-                                line[k] = time.hour
-                            elif derive["resolution"] == 'minute' and \
-                                    derive["aggregate"] == "day":
-                                k = "%s_hour_day" % field["field"]
-                                line[k] = time.hour*60 + time.minute
-                            else:
-                                logging.warning('Problem with aggregate resolution.')
-                                continue
-                        else:
-                            if derive["resolution"] == 'year':
-                                line["%s_year" % field["field"]] = intent[0]
-                            elif derive["resolution"] == 'month':
-                                try:
-                                    k = "%s_month" % field["field"]
-                                    dt = date(intent[0], intent[1], 1)
-                                    line[k] = DaysSinceZero(dt)
-                                except:
-                                    logging.warning("Problem with date fields\n")
-                                    pass
-                            elif derive['resolution'] == 'week':
-                                k = "%s_week" % field['field']
-                                dt = date(intent[0], intent[1], intent[2])
-                                inttime = DaysSinceZero(dt)
-                                time = int(inttime/7)*7
-                                #Not starting on Sunday or anything funky like that. Actually, I don't know what we're starting on. Adding an integer here would fix that.
-                                line[k] = time
-                            elif derive['resolution'] == 'day':
-                                k = "%s_day" % field['field']
-                                dt = date(intent[0], intent[1], intent[2])
-                                inttime = DaysSinceZero(dt)
-                                line[k] = inttime
-                            else:
-                                logging.warning('Resolution %s currently not supported.' % (derive['resolution']))
-                                continue
-                    except ValueError:
-                        # One of out a million Times articles threw this with
-                        # a year of like 111,203. It's not clear how best to
-                        # handle this.
-                        logging.warning("ERROR: %s " % line[field["field"]] +
-                                        "did not convert to proper date. Moving on...")
-                        # raise
-                        pass
-                    except Exception as e:
-                        logging.warning('*'*50)
-                        logging.warning('ERROR: %s\nINFO: %s\n' % (str(e), e.__doc__))
-                        logging.warning('*'*50)
-                line.pop(field["field"])
+                value = line[field["field"]]
+            except KeyError:
+                #It's OK not to have an entry for a time field
+                continue
+            if not isinstance(value, str) or value == "":
+                # Use blankness as a proxy for unknown; dates entered as
+                # numbers are left as they are.
+                continue
+            derived = derivers[field["field"]](value)
+            if derived is None:
+                continue
+            line.update(derived)
+            line.pop(field["field"])
         try:
-            el = json.dumps(line)
-            line_queue.put((line["filename"], el))
+            yield (line["filename"], json.dumps(line))
         except KeyError:
             logging.warning("No filename key in {}".format(line))
         except:
             logging.warning("Error on {}".format(line))
             raise
-    logging.debug("Metadata thread done after {} lines".format(i))
 
+# Each catalog worker's field descriptions and date caches, loaded on first use.
+catalog_parser = None
+
+def parse_catalog_chunk(shard):
+    """
+    Parse one (path, start, end) shard of jsoncatalog.txt in a worker,
+    returning a list of (filename, json line) in input order.
+    """
+    global catalog_parser
+    if catalog_parser is None:
+        fields_to_derive, fields = ParseFieldDescs(write = False)
+        derivers = dict([(field["field"], date_deriver(field)) for field in fields_to_derive])
+        catalog_parser = (fields_to_derive, fields, derivers)
+    return list(parse_json_catalog(read_shard(*shard), *catalog_parser))
+
+
+# Tabular catalogs that can be used instead of jsoncatalog.txt.
+columnar_catalogs = ["catalog.csv", "catalog.tsv", "catalog.parquet"]
+
+# Days before the first of each month, in a year that isn't a leap year.
+month_starts = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334])
+
+def derive_date_columns(field, values):
+    """
+    The columnar version of `date_deriver`: takes an array of date strings
+    and returns a boolean array of which ones parsed, and a dict of
+    derived field names to int64 arrays.
+
+    Each distinct string is parsed only once. ISO dates and years are
+    split apart with one regular expression over all of them; anything
+    else goes through `parse_date`. The derived fields are then computed
+    with numpy datetime arithmetic and broadcast back out to every row.
+    """
+    import pandas as pd
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    uniques = pd.Series(uniques, dtype=object)
+    n = len(uniques)
+
+    parts = uniques.str.extract(r"^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?$")
+    year = np.array(pd.to_numeric(parts[0]).fillna(1970), dtype=np.int64)
+    month = np.array(pd.to_numeric(parts[1]).fillna(1), dtype=np.int64)
+    day = np.array(pd.to_numeric(parts[2]).fillna(1), dtype=np.int64)
+    hour = np.zeros(n, dtype=np.int64)
+    minute = np.zeros(n, dtype=np.int64)
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    month_length = ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype(np.int64)
+    parsed = parts[0].notna().to_numpy() & (year >= 1) & \
+        (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_length)
+
+    # Everything else, including invalid ISO dates, gets the same
+    # treatment as in `parse_date`.
+    for i in np.flatnonzero(~parsed):
+        if uniques[i] == "":
+            continue
+        try:
+            time = parse_date(uniques[i])
+        except Exception:
+            continue
+        year[i], month[i], day[i] = time.year, time.month, time.day
+        hour[i], minute[i] = time.hour, time.minute
+        parsed[i] = True
+    year[~parsed], month[~parsed], day[~parsed] = 1970, 1, 1
+
+    days = ((year - 1970) * 12 + month - 1).astype("datetime64[M]").astype("datetime64[D]") + (day - 1)
+    days_since_zero = (days - np.datetime64("0001-01-01")).astype(np.int64) + 366
+    yday = (days - days.astype("datetime64[Y]").astype("datetime64[D]")).astype(np.int64) + 1
+
+    name = field["field"]
+    output = dict()
+    for derive in field["derived"]:
+        resolution, aggregate = derive["resolution"], derive.get("aggregate")
+        if aggregate is None and resolution == "year":
+            column = year
+        elif aggregate is None and resolution == "month":
+            column = days_since_zero - (day - 1)
+        elif aggregate is None and resolution == "week":
+            column = (days_since_zero // 7) * 7
+        elif aggregate is None and resolution == "day":
+            column = days_since_zero
+        elif (resolution, aggregate) == ("day", "year"):
+            column = yday
+        elif (resolution, aggregate) == ("day", "month"):
+            column = day
+        elif (resolution, aggregate) == ("day", "week"):
+            # Sunday is zero, as in javascript: 1970-01-01 was a Thursday.
+            column = (days.astype(np.int64) + 4) % 7
+        elif (resolution, aggregate) == ("month", "year"):
+            column = month_starts[month - 1] + 1
+        elif (resolution, aggregate) == ("week", "year"):
+            column = (yday // 7) * 7
+        elif (resolution, aggregate) == ("hour", "day"):
+            column = hour
+        elif (resolution, aggregate) == ("minute", "day"):
+            column = hour * 60 + minute
+        else:
+            logging.warning('Resolution %s currently not supported.' % (derive['resolution']))
+            continue
+        key = "_".join([name, resolution] + ([aggregate] if aggregate else []))
+        output[key] = column[codes]
+    return parsed[codes], output
+
+def read_catalog_chunks(path, chunksize=100000):
+    """
+    Yield a tabular catalog as DataFrames of strings, with missing
+    values as empty strings.
+    """
+    import pandas as pd
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        chunks = (batch.to_pandas() for batch in
+                  pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize))
+    else:
+        sep = "\t" if path.endswith(".tsv") else ","
+        chunks = pd.read_csv(path, sep=sep, dtype=str, keep_default_na=False,
+                             encoding="utf-8", chunksize=chunksize)
+    for chunk in chunks:
+        for column in chunk.columns:
+            missing = chunk[column].isna()
+            values = chunk[column].astype(str)
+            values[missing] = ""
+            chunk[column] = values
+        yield chunk
+
+def json_cells(values):
+    """
+    JSON-encode every item of a list in one call to the C encoder. A raw
+    NUL can't appear in the output except as the separator, since the
+    encoder escapes it inside strings.
+    """
+    if len(values) == 0:
+        return []
+    return json.dumps(values, separators=("\x00", ": "))[1:-1].split("\x00")
+
+def parse_columnar_catalog(path, chunksize=100000):
+    """
+    Yield a list of (filename, json line) for every chunk of a CSV, TSV,
+    or Parquet catalog, with the same derived fields as `parse_json_catalog`.
+
+    Empty cells are left out. A date that doesn't parse is kept as it is.
+    Lines are put together column by column, so the encoder is called
+    once per column per chunk rather than once per row.
+    """
+    fields_to_derive, fields = ParseFieldDescs(write = False)
+    for chunk in read_catalog_chunks(path, chunksize):
+        if "filename" not in chunk.columns:
+            raise KeyError("No filename column in {}".format(path))
+        values = dict([(column, chunk[column].to_numpy(dtype=object)) for column in chunk.columns])
+        present = dict([(column, values[column] != "") for column in chunk.columns])
+
+        derived = []
+        for field in fields_to_derive:
+            if field["field"] not in values:
+                continue
+            parsed, output = derive_date_columns(field, values[field["field"]])
+            present[field["field"]] &= ~parsed
+            for key, column in output.items():
+                derived.append((key, column.tolist(), parsed))
+
+        cells = []
+        for column in chunk.columns:
+            cells.append((column, json_cells(values[column].tolist()), present[column]))
+        for key, column, parsed in derived:
+            cells.append((key, json_cells(column), parsed))
+
+        columns = []
+        for key, encoded, keep in cells:
+            prefix = json.dumps(key) + ": "
+            columns.append([prefix + cell if k else "" for cell, k in zip(encoded, keep.tolist())])
+
+        lines = []
+        for filename, row in zip(values["filename"], zip(*columns)):
+            if filename == "":
+                logging.warning("No filename in row {}".format(row))
+                continue
+            lines.append((filename, "{" + ", ".join([cell for cell in row if cell]) + "}"))
+        yield lines
 
 def parse_catalog_multicore():
-    from .sqliteKV import KV
+    """
+    Write `jsoncatalog_derived.txt` and register a bookid for every filename.
+
+    The json catalog is split into contiguous chunks that a pool of workers
+    parses in parallel; the results come back in input order, so
+    bookids are assigned in catalog order on every run.
+    """
+    if not os.path.exists("jsoncatalog.txt"):
+        for path in columnar_catalogs:
+            if os.path.exists(path):
+                logging.info("Parsing the catalog from {}".format(path))
+                return write_derived_catalog(parse_columnar_catalog(path))
+
     cpus, _ = mp_stats()
-    encoded_queue = Queue(10000)
-    workers = []
-    
-    for i in range(cpus):
-        p = Process(target = parse_json_catalog, args = (encoded_queue, cpus, i))
-        p.start()
-        workers.append(p)
-    output = open(".bookworm/metadata/jsoncatalog_derived.txt", "w")
+    # Several chunks per process to even out the load, but none so big
+    # that a chunk of results sits in memory for long.
+    n = max(cpus * 4, os.path.getsize("jsoncatalog.txt") // CATALOG_CHUNK_BYTES)
+    chunks = shards("jsoncatalog.txt", n, ordered=True)
+    logging.info("Parsing the catalog in {} chunks on {} processes".format(len(chunks), cpus))
+    with Pool(cpus) as pool:
+        write_derived_catalog(pool.imap(parse_catalog_chunk, chunks))
 
+def write_derived_catalog(chunks):
+    """
+    Write chunks of (filename, json line) to `jsoncatalog_derived.txt` in
+    order, registering every filename as a bookid in one bulk load.
+    """
+    from .sqliteKV import KV
+    output = open(".bookworm/metadata/jsoncatalog_derived.txt", "w")
     bookids = KV(".bookworm/metadata/textids.sqlite")
-    import sqlite3
-    
-    while True:
-        try:
-            filename, n = encoded_queue.get_nowait()
-            output.write(n + "\n")
-            ids = set()
-            try:
-                bookids.register(filename)
-            except sqlite3.IntegrityError:
-                if filename in ids:
-                    logging.warning("Duplicate key insertion {}".format(filename))
-            ids.add(filename)
-                
-        except Empty:
-            if running_processes(workers):
-                # Give it a sec to fill back up to avoid this thread taking up
-                # a full processor.
-                time.sleep(0.01)
-            else:
-                # We're done!
-                break
-            
+
+    def filenames():
+        for chunk in chunks:
+            output.write("".join([line + "\n" for _, line in chunk]))
+            for filename, _ in chunk:
+                yield filename
+
+    ids, duplicates = bookids.register_many(filenames())
+    if len(duplicates) > 0:
+        logging.warning("{} filenames were already registered, including {}".format(
+            len(duplicates), ", ".join(duplicates[:5])))
     bookids.close()
     output.close()
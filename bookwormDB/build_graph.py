@@ -0,0 +1,264 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+"""
+Runs the stages of a bookworm build as a dependency graph.
+
+Each stage declares the stages it requires, the files it reads (paths,
+directories, or glob patterns), and the files it writes. A stage runs as soon as the stages it requires have
+finished, in its own process, alongside any others that are ready; so,
+for instance, parsing the catalog and counting the wordlist happen at once.
+
+Before running, a stage is fingerprinted by the content of its input
+files, its options, and the fingerprints of any required stages that
+write nothing to disk (such as the ones that load MySQL tables). It's
+skipped if that matches the fingerprint from the last time it ran and its
+outputs are all still there. So editing the catalog reruns the stages that
+read the catalog, but not tokenizing the texts. Outputs that aren't files,
+like tables, are looked at through the stage's checks instead: the stage
+runs again if what they return has changed since it finished.
+
+Files are only hashed again when their size or modification time changes.
+Everything is kept in `.bookworm/build`:
+
+    state.json      the fingerprint and timing of each stage's last run
+    hashes.json     content hashes, by path, size, and modification time
+    timing.txt      a report of the most recent build, stage by stage
+"""
+
+BUILD_DIR = ".bookworm/build"
+
+
+class Stage(object):
+    """
+    A step in the build.
+
+    `function` is called with no arguments in a child process; it has to
+    pickle (a module-level function or a bound method, or a
+    `functools.partial` of one) so the stage runs under any start method.
+    `clean` lists the outputs to remove before the stage runs again, for
+    steps that would otherwise keep what's already there.
+    `checks` are functions that describe outputs that aren't files (such
+    as the number of rows in a table), returning None if they're missing.
+    """
+    def __init__(self, name, function, requires=[], inputs=[], outputs=[], clean=[], options=None, checks=[]):
+        self.name = name
+        self.function = function
+        self.requires = requires
+        self.inputs = inputs
+        self.outputs = outputs
+        self.clean = clean
+        self.options = options
+        self.checks = checks
+
+    def __repr__(self):
+        return "Build stage '{}'".format(self.name)
+
+
+class FileHashes(object):
+    """
+    Content hashes of files and directories, cached by size and mtime.
+    """
+    def __init__(self, location):
+        self.location = location
+        self.cache = dict()
+        if os.path.exists(location):
+            with open(location) as fin:
+                self.cache = json.load(fin)
+
+    def file(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        try:
+            cached = self.cache[path]
+            if cached[:2] == signature:
+                return cached[2]
+        except KeyError:
+            pass
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(1024 * 1024), b""):
+                digest.update(block)
+        self.cache[path] = signature + [digest.hexdigest()]
+        return digest.hexdigest()
+
+    def path(self, path):
+        """
+        The hash of a file, of every file in a directory or matching a glob
+        pattern, or of nothing.
+        """
+        if any([c in path for c in "*?["]):
+            digest = hashlib.blake2b(digest_size=16)
+            for match in sorted(glob.glob(path)):
+                digest.update(match.encode("utf-8"))
+                digest.update(self.path(match).encode("utf-8"))
+            return digest.hexdigest()
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return "missing"
+        digest = hashlib.blake2b(digest_size=16)
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                digest.update(os.path.relpath(full, path).encode("utf-8"))
+                digest.update(self.file(full).encode("utf-8"))
+        return digest.hexdigest()
+
+    def save(self):
+        with open(self.location, "w") as fout:
+            json.dump(self.cache, fout)
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class BuildGraph(object):
+    """
+    Runs `stages`, keeping its state in `directory`. Stages start in
+    processes from `context`, a multiprocessing context (by default, the
+    platform's default start method).
+    """
+    def __init__(self, stages, directory=BUILD_DIR, context=None):
+        self.stages = dict([(stage.name, stage) for stage in stages])
+        self.order = [stage.name for stage in stages]
+        for stage in stages:
+            for required in stage.requires:
+                if required not in self.stages:
+                    raise ValueError("{} requires {}, which isn't a stage".format(stage.name, required))
+        self.directory = directory
+        self.context = context if context is not None else multiprocessing.get_context()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.state_location = os.path.join(directory, "state.json")
+        self.state = dict()
+        if os.path.exists(self.state_location):
+            with open(self.state_location) as fin:
+                self.state = json.load(fin)
+        self.hashes = FileHashes(os.path.join(directory, "hashes.json"))
+        self.keys = dict()
+        self.report = []
+
+    def fingerprint(self, stage):
+        description = {
+            "inputs": dict([(path, self.hashes.path(path)) for path in stage.inputs]),
+            "options": stage.options,
+            "requires": dict([(name, self.keys[name]) for name in stage.requires
+                              if len(self.stages[name].outputs) == 0])
+        }
+        encoded = json.dumps(description, sort_keys=True).encode("utf-8")
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    def up_to_date(self, stage):
+        last = self.state.get(stage.name)
+        if last is None or last["key"] != self.keys[stage.name]:
+            return False
+        if not all([os.path.exists(path) for path in stage.outputs]):
+            return False
+        if len(stage.checks) == 0:
+            return True
+        checks = self.check(stage)
+        return None not in checks and checks == last.get("checks")
+
+    def check(self, stage):
+        return [check() for check in stage.checks]
+
+    def save(self):
+        with open(self.state_location, "w") as fout:
+            json.dump(self.state, fout, indent=2)
+        self.hashes.save()
+
+    def start(self, name):
+        stage = self.stages[name]
+        # Until it finishes, the stage isn't up to date no matter what.
+        self.state.pop(name, None)
+        self.save()
+        for path in stage.clean:
+            remove(path)
+        logging.info("Starting build stage {}".format(name))
+        process = self.context.Process(target=stage.function, name=name)
+        process.start()
+        return process
+
+    def run(self, targets=None):
+        """
+        Build `targets` (by default, every stage) and everything they require.
+        """
+        if targets is None:
+            targets = self.order
+        needed = set()
+        def require(name):
+            if name not in needed:
+                needed.add(name)
+                for required in self.stages[name].requires:
+                    require(required)
+        for target in targets:
+            require(target)
+
+        waiting = [name for name in self.order if name in needed]
+        running = dict()
+        done = set()
+        failed = []
+        t0 = time.time()
+        while len(waiting) > 0 or len(running) > 0:
+            ready = [name for name in waiting if len(failed) == 0 and
+                     all([required in done for required in self.stages[name].requires])]
+            for name in ready:
+                waiting.remove(name)
+                self.keys[name] = self.fingerprint(self.stages[name])
+                if self.up_to_date(self.stages[name]):
+                    logging.info("Skipping build stage {}, which is up to date".format(name))
+                    self.report.append((name, "skipped", 0))
+                    done.add(name)
+                else:
+                    running[name] = (self.start(name), time.time())
+            if len(running) == 0:
+                if len(failed) > 0:
+                    break
+                if len(ready) == 0 and len(waiting) > 0:
+                    raise ValueError("Build stages {} require each other".format(waiting))
+                # Skipping stages may have readied others.
+                continue
+            multiprocessing.connection.wait([process.sentinel for process, _ in running.values()])
+            for name, (process, started) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[name]
+                seconds = time.time() - started
+                if process.exitcode != 0:
+                    logging.error("Build stage {} failed with code {}".format(name, process.exitcode))
+                    self.report.append((name, "failed", seconds))
+                    failed.append(name)
+                    continue
+                logging.info("Finished build stage {} in {:.1f} seconds".format(name, seconds))
+                self.report.append((name, "ran", seconds))
+                self.state[name] = {"key": self.keys[name], "seconds": seconds, "finished": time.time(),
+                                    "checks": self.check(self.stages[name])}
+                self.save()
+                done.add(name)
+        self.save()
+        self.write_report(time.time() - t0)
+        if len(failed) > 0:
+            raise RuntimeError("Build stages failed: {}".format(", ".join(failed)))
+
+    def write_report(self, total):
+        lines = ["{}\t{}\t{:.2f}".format(name, status, seconds) for name, status, seconds in self.report]
+        lines.append("total\t\t{:.2f}".format(total))
+        with open(os.path.join(self.directory, "timing.txt"), "w") as fout:
+            fout.write("stage\tstatus\tseconds\n")
+            fout.write("\n".join(lines) + "\n")
+        for line in lines:
+            logging.info(line.replace("\t", " "))
@@ -2,9 +2,12 @@ import sys
 import os
 import bounter
 from collections import Counter
-from .tokenizer import Tokenizer, tokenBatches, PreTokenized
+from .tokenizer import Tokenizer, tokenBatches, PreTokenized, readIDfile
 from multiprocessing import Process, Queue, Pool
 from .multiprocessingHelp import mp_stats, running_processes
+from .sharded_input import shards, read_shard, input_files
+from .vocabulary import build_vocabulary
+from .token_cache import TokenCacheWriter, cache_segments, read_segment
 import multiprocessing as mp
 import psutil
 import queue
@@ -12,6 +15,7 @@ import logging
 import fileinput
 import time
 import csv
+import json
 
 cpus, memory = mp_stats()
 
@@ -29,140 +33,505 @@ QUEUE_POST_THRESH = max([100000, QUEUE_POST_THRESH])
 
 logging.info("Filling dicts to size {}".format(QUEUE_POST_THRESH))
 
+# Where the token streams are cached while building the wordlist.
+TOKEN_CACHE = ".bookworm/texts/tokens"
+
+# Merge worker counts through intermediate processes once there
+# are more than this many workers posting to one queue.
+MERGE_FANOUT = 16
+
+# The most spilled runs to hold open and merge at once.
+SPILL_MERGE_WIDTH = 256
+
 import random
-import gzip
+import heapq
+import tempfile
+import numpy as np
+from itertools import groupby
+
+def spill_counter(counter, spill_dir, i, n):
+    """
+    Write a worker's counts to disk as a run of 'word\tcount' lines
+    sorted by word, for `merged_counts` to combine later.
+    """
+    for k in ['', '\x00']:
+        del counter[k]
+    path = os.path.join(spill_dir, "{:05d}-{:06d}.txt".format(i, n))
+    with open(path, "w", encoding="utf-8") as fout:
+        for word in sorted(counter):
+            fout.write("{}\t{}\n".format(word, counter[word]))
+
+def read_run(path):
+    with open(path, encoding="utf-8") as fin:
+        for line in fin:
+            word, count = line.rstrip("\n").rsplit("\t", 1)
+            yield word, int(count)
+
+def combined_runs(paths):
+    runs = [read_run(path) for path in paths]
+    for word, group in groupby(heapq.merge(*runs), key = lambda x: x[0]):
+        yield word, sum(count for _, count in group)
+
+def merged_counts(spill_dir):
+    """
+    K-way merge of every sorted run in spill_dir, yielding each word once
+    (in sorted order) with its total count.
+
+    So as not to run out of file handles, runs are first merged in groups
+    of SPILL_MERGE_WIDTH into longer runs, in as many passes as it takes.
+    """
+    paths = [os.path.join(spill_dir, f) for f in sorted(os.listdir(spill_dir))]
+    passes = 0
+    while len(paths) > SPILL_MERGE_WIDTH:
+        merged = []
+        for start in range(0, len(paths), SPILL_MERGE_WIDTH):
+            group = paths[start:start + SPILL_MERGE_WIDTH]
+            path = os.path.join(spill_dir, "merged-{:03d}-{:06d}.txt".format(passes, start))
+            with open(path, "w", encoding="utf-8") as fout:
+                for word, count in combined_runs(group):
+                    fout.write("{}\t{}\n".format(word, count))
+            for done in group:
+                os.remove(done)
+            merged.append(path)
+        paths = merged
+        passes += 1
+    return combined_runs(paths)
+
+def pack_counts(counter):
+    """
+    Flatten a Counter into (text, lengths, counts) for the queue: the
+    words joined end to end, and two numpy arrays. This pickles far
+    faster than the dict itself.
+    """
+    words = list(counter)
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    counts = np.fromiter(counter.values(), dtype=np.int64, count=len(words))
+    return ("".join(words), lengths, counts)
+
+def unpack_counts(payload):
+    """
+    The inverse of `pack_counts`: returns a dict of word counts.
+    """
+    text, lengths, counts = payload
+    ends = np.cumsum(lengths).tolist()
+    starts = [0] + ends[:-1]
+    return dict(zip([text[a:b] for a, b in zip(starts, ends)], counts.tolist()))
 
 def flush_counter(counter, qout):
     for k in ['', '\x00']:
-        try:
-            del counter[k]
-        except KeyError:
+        counter.pop(k, None)
+    if len(counter) > 0:
+        qout.put(pack_counts(counter))
+
+def merge_relay(qin, qout, sources):
+    """
+    An intermediate node in the merge tree: combines the counts from
+    `sources` senders on qin, passes them up to qout whenever they grow
+    past QUEUE_POST_THRESH, and signals its own end with None.
+    """
+    counter = Counter()
+    finished = 0
+    while finished < sources:
+        payload = qin.get()
+        if payload is None:
+            finished += 1
             continue
-        qout.put(counter)
+        counter.update(unpack_counts(payload))
+        if len(counter) > QUEUE_POST_THRESH:
+            flush_counter(counter, qout)
+            counter = Counter()
+    flush_counter(counter, qout)
+    qout.put(None)
+
+def merge_queues(sources, qout, processes):
+    """
+    Build a tree of `merge_relay` processes so that no queue has more than
+    MERGE_FANOUT senders. Returns the queue each of the `sources` senders
+    should post to; the relays started are appended to `processes`.
+    """
+    if sources <= MERGE_FANOUT:
+        return [qout] * sources
+    groups = -(-sources // MERGE_FANOUT)
+    upstream = merge_queues(groups, qout, processes)
+    queues = []
+    for g in range(groups):
+        size = min(MERGE_FANOUT, sources - g * MERGE_FANOUT)
+        qin = Queue(MERGE_FANOUT * 2)
+        p = Process(target = merge_relay, args = (qin, upstream[g], size))
+        p.start()
+        processes.append(p)
+        queues.extend([qin] * size)
+    return queues
+
+def merge_tree_width(sources):
+    """
+    The number of senders (and so end signals) on the root queue.
+    """
+    while sources > MERGE_FANOUT:
+        sources = -(-sources // MERGE_FANOUT)
+    return sources
         
-def counter(qout, i, fin, mode = "count"):
+def tokenized_rows(rows, tokenizer_class):
+    """
+    Split 'filename\ttext' rows, yielding (filename, tokenizer). The tokenizer
+    is None for rows without a tab.
+    """
+    for row in rows:
+        try:
+            (filename, text) = row.rstrip().split("\t",1)
+        except ValueError:
+            yield (None, None)
+            continue
+        yield (filename, tokenizer_class(text))
+
+def pretokenized_rows(rows, level, blocksize = 2000):
+    """
+    Like `tokenized_rows` for feature-count files, but parses blocks of
+    rows together with `PreTokenized.batch`.
+    """
+    def parse(block):
+        filenames = [filename for filename, _ in block]
+        tokenizers = PreTokenized.batch([text for _, text in block], level)
+        return zip(filenames, tokenizers)
+
+    block = []
+    for row in rows:
+        try:
+            (filename, text) = row.rstrip().split("\t",1)
+        except ValueError:
+            yield from parse(block)
+            block = []
+            yield (None, None)
+            continue
+        block.append((filename, text))
+        if len(block) >= blocksize:
+            yield from parse(block)
+            block = []
+    yield from parse(block)
+
+def input_datatype(path):
+    """
+    'raw' for text files, or the count level ('unigrams', etc.) for
+    pre-tokenized feature-count files, which are named like 'input.unigrams'.
+    """
+    for signal in [".unigrams", ".bigrams", ".trigrams", ".quadgrams"]:
+        if signal in path:
+            return signal.strip(".")
+    return "raw"
+
+def shard_documents(shard, level):
+    """
+    Yield (filename, tokenizer) for every row of a shard, as
+    `tokenized_rows` or `pretokenized_rows` depending on the file type.
+    """
+    rows = read_shard(*shard)
+    if input_datatype(shard[0]) == "raw":
+        return tokenized_rows(rows, Tokenizer)
+    return pretokenized_rows(rows, level)
+
+def counter(qout, i, shard, engine = "python", spill_dir = None, token_cache = None):
     """
     # Counts words exactly in a separate process.
     # It runs in place.
-    If mode is 'encode', this is called for a side-effect of writing
-    files to disk.
-    """
 
+    shard: a (path, start, end) tuple from `sharded_input.shards`;
+    each worker reads only its own byte range of the input.
+    engine: the n-gram counting engine, as in `Tokenizer.counts`.
+    spill_dir: if set, counts are written to sorted files in this
+    directory rather than posted to the master (see `create_counts_exact`).
+    token_cache: if set while counting raw text, each document's tokens are
+    also written to this directory so that `encode_cached` can encode them
+    later without tokenizing again.
+    """
     totals = 0
     errors = 0
+    spills = 0
     
-    if mode == "count":
-        counter = Counter()
-        encoder = tokenBatches(['words'])
-        
-    if mode == "encode":
-        encoder = tokenBatches(['unigrams', 'bigrams'])
-        
-    datatype = "raw"
-    
-    count_signals = [".unigrams", ".bigrams", ".trigrams", ".quadgrams"]
-    for signal in count_signals:
-        if signal in fin:
-            datatype = signal.strip(".")
-            if mode == "encode":
-                encoder = tokenBatches([datatype])            
-        
-    if (fin.endswith(".gz")):
-        fin = gzip.open(fin, 'rt')
-    else:
-        fin = open(fin)
+    counter = Counter()
 
-    
-    for ii, row in enumerate(fin):
-        if ii % cpus != i:
-            # Don't do anything on most lines.
-            continue
+    cache = None
+    if token_cache is not None and input_datatype(shard[0]) == "raw":
+        cache = TokenCacheWriter(token_cache, i)
+
+    for filename, tokenizer in shard_documents(shard, "words"):
         totals += 1
-        try:
-            (filename, text) = row.rstrip().split("\t",1)
-        except ValueError:
+        if tokenizer is None:
             errors += 1
             continue
-        
-        if datatype == "raw":
-            tokenizer = Tokenizer(text)
-        else:
-            tokenizer = PreTokenized(text, encoder.levels[0])
 
-        # When encoding
-        if mode == "encode":
-            encoder.encodeRow(filename, tokenizer, write_completed = True)
-            continue
-        
         # When building counts
-        counter.update(tokenizer.counts("words"))
+        if cache is not None:
+            cache.add(filename, tokenizer.tokenize())
+        counter.update(tokenizer.counts("words", engine = engine))
             
         # When the counter is long, post it to the master and clear it.
         if len(counter) > QUEUE_POST_THRESH:
-            flush_counter(counter=counter, qout = qout)
+            if spill_dir is not None:
+                spill_counter(counter, spill_dir, i, spills)
+                spills += 1
+            else:
+                flush_counter(counter=counter, qout = qout)
             counter = Counter()
 
     # Cleanup.
-    if mode == "count":
-        logging.debug("Flushing leftover counts from thread {}".format(i))
+    if cache is not None:
+        cache.close()
+    logging.debug("Flushing leftover counts from thread {}".format(i))
+    if spill_dir is not None:
+        spill_counter(counter, spill_dir, i, spills)
+    else:
         flush_counter(counter=counter, qout = qout)
-        if totals > 0 and errors/totals > 0.01:
-            logging.warning("Skipped {} rows without tabs".format(errors))
-    if mode == "encode":
-        encoder.close()
+        # Tell the master this worker is done.
+        qout.put(None)
+    if totals > 0 and errors/totals > 0.01:
+        logging.warning("Skipped {} rows without tabs".format(errors))
 
-def create_counts(input):
+def create_counts(input, engine = "python", token_cache = None):
+    """
+    Count words approximately in a `bounter`.
+
+    Workers post packed counts (see `pack_counts`) and then None when
+    they finish. With more than MERGE_FANOUT workers, their counts are
+    combined in a tree of relay processes on the way, so the master only
+    sees a few already-merged streams.
+    """
     qout = Queue(cpus * 2)
     workers = []
-    logging.info("Spawning {} count processes on {}".format(cpus, input))
-    for i in range(cpus):
-        p = Process(target = counter, args = (qout, i, input, "count"))
+    input_shards = shards(input, cpus)
+    queues = merge_queues(len(input_shards), qout, workers)
+    logging.info("Spawning {} count processes on {}".format(len(input_shards), input))
+    for i, shard in enumerate(input_shards):
+        p = Process(target = counter, args = (queues[i], i, shard, engine),
+                    kwargs = {"token_cache": token_cache})
         p.start()
         workers.append(p)
 
     wordcounter = bounter.bounter(memory)
-    
-    while True:
-        
-        try:
-            input_dict = qout.get_nowait()
+
+    remaining = merge_tree_width(len(input_shards))
+    try:
+        while remaining > 0:
+            try:
+                payload = qout.get(timeout = 1)
+            except queue.Empty:
+                # Raises if a worker died; otherwise they're just slow.
+                if not running_processes(workers):
+                    raise RuntimeError("Count processes exited without finishing")
+                continue
+            if payload is None:
+                remaining -= 1
+                continue
+            input_dict = unpack_counts(payload)
             logging.debug("inputting queue of length {} from worker".format(len(input_dict)))
             wordcounter.update(input_dict)
-            
-        except queue.Empty:
-            if running_processes(workers):
-                time.sleep(1/100)
-            else:
-                break
-        except ValueError:
-            for k, v in input_dict.items():
-                print("'{}'\t'{}'".format(k, v))                
-                wordcounter.update({k: v})
-            raise
-        except TypeError:
-            for k, v in input_dict.items():
-                print("'{}'\t'{}'".format(k, v))                
-                wordcounter.update({k: v})
-            raise
-        
+    except:
+        # A dead worker leaves the relays above it waiting forever,
+        # so stop everything that's still running before giving up.
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+        for p in workers:
+            p.join()
+        raise
+
+    for p in workers:
+        p.join()
     return wordcounter
 
-def create_wordlist(n, input, output):
-    
-    counter = create_counts(input)
-    counter = sorted(list(counter.iteritems()), key = lambda x: -1 * x[1])
+def create_counts_exact(input, n, engine = "python", tmpdir = None, token_cache = None):
+    """
+    Count every word exactly, in bounded memory, and return the top n
+    as a list of (word, count) pairs.
+
+    Each worker spills its counts to sorted files on disk whenever it holds
+    more than QUEUE_POST_THRESH words; the runs are then merged and the
+    top n are kept with a heap. Ties are broken alphabetically, so the
+    result is the same on every run.
+    """
+    with tempfile.TemporaryDirectory(dir = tmpdir, prefix = "wordcounts-") as spill_dir:
+        workers = []
+        logging.info("Spawning {} exact count processes on {}".format(cpus, input))
+        for i, shard in enumerate(shards(input, cpus)):
+            p = Process(target = counter, args = (None, i, shard, engine, spill_dir),
+                        kwargs = {"token_cache": token_cache})
+            p.start()
+            workers.append(p)
+        for p in workers:
+            p.join()
+        # Raises if any worker died.
+        running_processes(workers)
+        logging.info("Merging {} sorted count files".format(len(os.listdir(spill_dir))))
+        # heapq.nlargest is stable, so equal counts stay in alphabetical order.
+        return heapq.nlargest(n, merged_counts(spill_dir), key = lambda x: x[1])
+
+def create_wordlist(n, input, output, engine = "python", exact = False, token_cache = None):
+    """
+    token_cache: a directory in which to also save every document's
+    tokens, for `encode_cached`.
+
+    Any tokens cached with an earlier wordlist are removed either way,
+    since encoding them against this one would give the wrong wordids.
+    """
+    clear_token_cache(TOKEN_CACHE, recreate = False)
+    if token_cache is not None:
+        clear_token_cache(token_cache)
+
+    if exact:
+        counter = create_counts_exact(input, int(n) + 1, engine = engine,
+                                      tmpdir = os.path.dirname(output) or None,
+                                      token_cache = token_cache)
+    else:
+        counter = create_counts(input, engine = engine, token_cache = token_cache)
+        # A heap keeps the top n without sorting the whole vocabulary.
+        counter = heapq.nlargest(int(n) + 1, counter.iteritems(), key = lambda x: x[1])
     output = open(output, "w")
     for i, (k, v) in enumerate(counter):
         output.write("{}\t{}\t{}\n".format(i, k, v))
         if i >= n:
             break
+    output.close()
+
+    if token_cache is not None:
+        # Mark the cache as usable only once every worker has finished,
+        # with a record of the input and wordlist it goes with.
+        with open(os.path.join(token_cache, "complete"), "w") as fout:
+            json.dump(token_cache_fingerprint(input, output.name), fout)
+
+def clear_token_cache(token_cache, recreate = True):
+    if os.path.exists(token_cache):
+        import shutil
+        shutil.rmtree(token_cache)
+    if recreate:
+        os.makedirs(token_cache)
+
+def token_cache_fingerprint(input, wordlist):
+    """
+    The input files, by path, size, and modification time, and a hash of
+    the wordlist's contents.
+    """
+    import hashlib
+    files = []
+    for path in input_files(input):
+        stat = os.stat(path)
+        files.append([path, stat.st_size, stat.st_mtime_ns])
+    with open(wordlist, "rb") as fin:
+        digest = hashlib.blake2b(fin.read(), digest_size = 16).hexdigest()
+    return {"input": files, "wordlist": digest}
+
+def token_cache_matches(token_cache, input, wordlist):
+    """
+    Whether a token cache is complete and was made from this input along
+    with this wordlist.
+    """
+    marker = os.path.join(token_cache, "complete")
+    if not os.path.exists(marker):
+        return False
+    try:
+        with open(marker) as fin:
+            saved = json.load(fin)
+    except ValueError:
+        return False
+    return saved == token_cache_fingerprint(input, wordlist)
         
-def encode_words(wordlist, input = "input.txt"):
-    qout = Queue(cpus * 2)
-    workers = []
+def encode_worker(tasks, engine = "python"):
+    """
+    A long-lived encoding process. It takes shards from the `tasks` queue
+    until it gets None, keeping one encoder (and so one set of output
+    files) per input type, and loading the dictionary and ID lookup only once.
+    """
+    encoders = dict()
+    totals = 0
+    errors = 0
+    while True:
+        shard = tasks.get()
+        if shard is None:
+            break
+        datatype = input_datatype(shard[0])
+        if datatype not in encoders:
+            levels = ['unigrams', 'bigrams'] if datatype == "raw" else [datatype]
+            encoder = tokenBatches(levels, engine = engine)
+            encoder.createOutputFiles()
+            if len(encoders) == 0:
+                encoder.attachDictionaryAndID()
+            else:
+                first = next(iter(encoders.values()))
+                encoder.dictionary, encoder.IDfile = first.dictionary, first.IDfile
+            encoders[datatype] = encoder
+        encoder = encoders[datatype]
+        for filename, tokenizer in shard_documents(shard, encoder.levels[0]):
+            totals += 1
+            if tokenizer is None:
+                errors += 1
+                continue
+            encoder.encodeRow(filename, tokenizer, write_completed = True)
+
+    for encoder in encoders.values():
+        encoder.close()
+    if totals > 0 and errors/totals > 0.01:
+        logging.warning("Skipped {} rows without tabs".format(errors))
+
+def encode_words(wordlist, input = "input.txt", engine = "python"):
+    """
+    Encode every document in `input`: a file, a directory, a glob pattern,
+    or a list of any of those. Raw text and feature-count files can be mixed.
 
+    The input is split into shards that a fixed pool of `cpus` workers
+    take from a queue, so the cost of starting workers doesn't grow with
+    the number of input files.
+    """
+    paths = input_files(input)
+
+    # Build the shared vocabulary and bookid lookup once here,
+    # rather than in each worker.
+    build_vocabulary(wordlist)
+    textids = readIDfile()
+    textids.export()
+    textids.close()
+
+    tasks = Queue()
+    workers = []
     for i in range(cpus):
-        p = Process(target = counter, args = (qout, i, input, "encode"))
+        p = Process(target = encode_worker, args = (tasks, engine))
+        p.start()
+        workers.append(p)
+
+    # More shards than workers, so that the load stays even when
+    # some shards are slower than others.
+    input_shards = shards(paths, cpus * 4)
+    logging.info("Encoding {} shards of {} files on {} processes".format(len(input_shards), len(paths), cpus))
+    for shard in input_shards:
+        tasks.put(shard)
+    for p in workers:
+        tasks.put(None)
+
+    while running_processes(workers):
+        time.sleep(1/30)
+
+def cached_encoder(segments):
+    encoder = tokenBatches(['unigrams', 'bigrams'])
+    encoder.createOutputFiles()
+    encoder.attachDictionaryAndID()
+    for segment in segments:
+        for filename, tokens in read_segment(segment, encoder.dictionary):
+            encoder.encodeRow(filename, tokens, write_completed = True)
+    encoder.close()
+
+def encode_cached(wordlist, token_cache):
+    """
+    Write the encoded unigram and bigram files from the token streams
+    saved while building the wordlist, instead of tokenizing the input
+    a second time.
+    """
+    build_vocabulary(wordlist)
+    textids = readIDfile()
+    textids.export()
+    textids.close()
+
+    segments = [os.path.join(token_cache, s) for s in cache_segments(token_cache)]
+    logging.info("Encoding {} cached token segments".format(len(segments)))
+    workers = []
+    for i in range(min(cpus, len(segments))):
+        p = Process(target = cached_encoder, args = (segments[i::cpus], ))
         p.start()
         workers.append(p)
 
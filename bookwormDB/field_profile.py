@@ -0,0 +1,243 @@
+import os
+import re
+import json
+import hashlib
+import random
+import logging
+import numpy as np
+from collections import Counter
+from multiprocessing import Pool
+from .multiprocessingHelp import mp_stats
+from .sharded_input import shards, read_shard
+
+"""
+Profiles every field of a json-lines catalog in one streaming pass,
+for guessing at field descriptions.
+
+Each field keeps, in bounded memory:
+
+    count       the number of values seen (list items counted separately)
+    distinct    a HyperLogLog estimate of the number of distinct values
+    top         the most common values, as a mergeable Misra-Gries summary
+    sample      a uniform reservoir sample of values from the whole file
+
+The file is split into chunks that are profiled in parallel, and the
+profiles of the chunks are merged in input order.
+"""
+
+# HyperLogLog registers are 2**HLL_PRECISION bytes per field (about 1.6% error).
+HLL_PRECISION = 12
+TOP_K = 100
+SAMPLE_SIZE = 1000
+
+# Roughly how much of the catalog each worker profiles at a time.
+PROFILE_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def value_hashes(values):
+    """
+    64-bit hashes of any json values, as a uint64 array.
+    """
+    digests = b"".join([hashlib.blake2b(repr(value).encode("utf-8"), digest_size=8).digest()
+                        for value in values])
+    return np.frombuffer(digests, dtype="<u8")
+
+
+class HyperLogLog(object):
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        if len(hashes) == 0:
+            return
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - p)) - 1)
+        # The rank is the position of the first set bit in the remaining bits.
+        _, exponent = np.frexp(rest.astype(np.float64))
+        rank = (64 - p) - exponent + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # Linear counting is more accurate for small sets.
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+def top_values(counts, k=TOP_K):
+    """
+    Reduce a Counter to a Misra-Gries summary of at most k values: every
+    count is lowered by the (k+1)th largest, which keeps the summaries of
+    different chunks mergeable by just adding them up and reducing again.
+    """
+    if len(counts) <= k:
+        return counts
+    ranked = counts.most_common(k + 1)
+    floor = ranked[-1][1]
+    return Counter(dict([(value, count - floor) for value, count in ranked[:k] if count > floor]))
+
+
+class FieldProfile(object):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.rows = 0
+        self.lists = 0
+        self.distinct = HyperLogLog()
+        self.top = Counter()
+        self.sample = []
+        self.example = None
+
+    def add(self, values, rng):
+        """
+        Add the values of this field from one chunk, in input order: a
+        list of the field's value in each row that has it.
+        """
+        items = []
+        for value in values:
+            self.rows += 1
+            if isinstance(value, list):
+                self.lists += 1
+                items.extend(value)
+            else:
+                items.append(value)
+        if len(items) == 0:
+            return
+        if self.count == 0:
+            self.example = items[0]
+        try:
+            counts = Counter(items)
+        except TypeError:
+            # Nested objects count by their json.
+            counts = Counter([json.dumps(item, sort_keys=True) if isinstance(item, (dict, list)) else item
+                              for item in items])
+        # Only the chunk's distinct values need hashing.
+        self.distinct.add_hashes(value_hashes(counts))
+        self.top = top_values(self.top + counts)
+        chunk_sample = items if len(items) <= SAMPLE_SIZE else rng.sample(items, SAMPLE_SIZE)
+        self.sample = merge_samples(self.sample, self.count, chunk_sample, len(items), rng)
+        self.count += len(items)
+
+    def merge(self, other, rng):
+        """
+        Combine the profile of a later chunk into this one.
+        """
+        if self.count == 0:
+            self.example = other.example
+        self.rows += other.rows
+        self.lists += other.lists
+        self.distinct.merge(other.distinct)
+        self.top = top_values(self.top + other.top)
+        self.sample = merge_samples(self.sample, self.count, other.sample, other.count, rng)
+        self.count += other.count
+
+
+def merge_samples(a, na, b, nb, rng):
+    """
+    Merge uniform samples `a` and `b` of populations of size `na` and `nb`
+    into a uniform sample of their union.
+    """
+    if len(a) + len(b) <= SAMPLE_SIZE:
+        return a + b
+    size = SAMPLE_SIZE
+    # How many of the merged sample come from `a`.
+    from_a = 0
+    remaining_a, remaining_b = na, nb
+    for _ in range(size):
+        if rng.random() * (remaining_a + remaining_b) < remaining_a:
+            from_a += 1
+            remaining_a -= 1
+        else:
+            remaining_b -= 1
+    from_a = max(size - len(b), min(from_a, len(a)))
+    return rng.sample(a, from_a) + rng.sample(b, size - from_a)
+
+
+def profile_lines(lines, seed=0):
+    """
+    Profile json lines; returns a dict of FieldProfiles in the order the
+    fields first appear.
+    """
+    rng = random.Random(seed)
+    columns = dict()
+    for i, line in enumerate(lines):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logging.warning("Error parsing line {}: {}".format(i, line))
+            continue
+        for key, value in entry.items():
+            try:
+                columns[key].append(value)
+            except KeyError:
+                columns[key] = [value]
+    profiles = dict()
+    for key, values in columns.items():
+        profiles[key] = FieldProfile(key)
+        profiles[key].add(values, rng)
+    return profiles
+
+
+def guess_description(profile):
+    """
+    Guess a field description from its profile. Like the old guess from
+    the head of the file, this treats everything as a categorical
+    character field unless there's reason to think otherwise.
+    """
+    name = profile.name
+    if name == "searchstring":
+        return {"datatype": "searchstring", "field": "searchstring", "unique": True, "type": "text"}
+
+    description = {"field": name, "datatype": "categorical", "type": "character", "unique": True}
+
+    if len(profile.sample) > 0 and all(type(value) == int for value in profile.sample):
+        description["type"] = "integer"
+
+    if profile.lists > 0:
+        description["unique"] = False
+
+    if re.search("date", name) or re.search("time", name):
+        description["datatype"] = "time"
+
+    averageNumberOfEntries = profile.count / max(profile.distinct.estimate(), 1)
+
+    if averageNumberOfEntries > 2:
+        description["datatype"] = "categorical"
+
+    return description
+
+
+def profile_chunk(args):
+    shard, seed = args
+    return profile_lines(read_shard(*shard), seed)
+
+
+def profile_file(path, processes=None):
+    """
+    Profile every field in a json-lines file, in parallel.
+    """
+    if processes is None:
+        processes, _ = mp_stats()
+    n = max(processes * 4, os.path.getsize(path) // PROFILE_CHUNK_BYTES)
+    # Seeds by chunk, so the samples are the same on every run.
+    tasks = [(shard, i) for i, shard in enumerate(shards(path, n, ordered=True))]
+    rng = random.Random(len(tasks))
+    profiles = dict()
+    logging.info("Profiling {} in {} chunks on {} processes".format(path, len(tasks), processes))
+    with Pool(processes) as pool:
+        for chunk in pool.imap(profile_chunk, tasks):
+            for key, profile in chunk.items():
+                if key in profiles:
+                    profiles[key].merge(profile, rng)
+                else:
+                    profiles[key] = profile
+    return profiles
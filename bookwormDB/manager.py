@@ -24,6 +24,32 @@ for the command-line executable,
 even though it's not best practice otherwise.
 """
 
+def load_tables(dbname, method, **kwargs):
+    """
+    Run one of the BookwormSQLDatabase methods that builds tables, as a
+    build stage.
+    """
+    import bookwormDB.CreateDatabase
+    Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(dbname)
+    getattr(Bookworm, method)(**kwargs)
+
+def table_rows(dbname, tablename):
+    """
+    The number of rows in a table, or None if it doesn't exist: the
+    check for a build stage that loads it.
+    """
+    from bookwormDB.CreateDatabase import DB
+    db = DB(dbname)
+    db.connect()
+    try:
+        exists = db.query("SELECT COUNT(*) FROM information_schema.tables "
+                          "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s", (dbname, tablename)).fetchall()[0][0]
+        if not exists:
+            return None
+        return int(db.query("SELECT COUNT(*) FROM " + tablename).fetchall()[0][0])
+    finally:
+        db.conn.close()
+
 class BookwormManager(object):
     """
     This class is passed some options that tell it the name of the bookworm it's working on;
@@ -39,6 +65,8 @@ section'client'
 
         self.basedir = None
         self.dbname = None
+        # Options from the [build] section of the config file.
+        self.build_options = dict()
         for i in range(10):
             basedir = "../"*i
             if os.path.exists(basedir + ".bookworm"):
@@ -58,6 +86,8 @@ section'client'
                     self.dbname = config.get("client", "database")
                 except configParser.NoOptionError:
                     pass
+            if config.has_section("build"):
+                self.build_options = dict(config.items("build"))
 
         # More specific options override the config file
         if database is not None:
@@ -140,6 +170,23 @@ section'client'
         caller = SQLAPIcall(query)
         print(caller.execute())
 
+    def reshard(self, args):
+        """
+        Recompress a gzip input file as many gzip members, so that its lines
+        can be split between worker processes without each of them
+        decompressing the whole file.
+        """
+        from .sharded_input import write_gzip_shards, gzip_member_index
+        output = args.output
+        if output is None:
+            output = args.input if args.input.endswith(".gz") else args.input + ".gz"
+        if output == args.input:
+            write_gzip_shards(args.input, output + ".resharding", lines_per_member=args.lines_per_member)
+            os.replace(output + ".resharding", output)
+        else:
+            write_gzip_shards(args.input, output, lines_per_member=args.lines_per_member)
+        logging.info("Wrote {} gzip members to {}".format(len(gzip_member_index(output)), output))
+
     def serve(self,args):
 
         """
@@ -219,7 +266,7 @@ section'client'
         """
         Create a wordlist of the top 1.5 million words.
         """
-        from .countManager import create_wordlist
+        from .countManager import create_wordlist, TOKEN_CACHE
         if os.path.exists(".bookworm/texts/wordlist/wordlist.txt"):
             return
         try:
@@ -228,12 +275,19 @@ section'client'
             pass
 
         input = "input.txt"
+        token_cache = None
+        if getattr(args, "cache_tokens", False) and not args.feature_counts:
+            token_cache = TOKEN_CACHE
         if args.feature_counts:
             logging.info(args.feature_counts)
-            input = [a for a in args.feature_counts if 'unigrams' in a][0]
+            from .sharded_input import input_files
+            input = [a for a in input_files(args.feature_counts) if 'unigrams' in a]
         create_wordlist(n = 1.5e06,
                         input = input,
-                        output = ".bookworm/texts/wordlist/wordlist.txt")
+                        output = ".bookworm/texts/wordlist/wordlist.txt",
+                        engine = getattr(args, "count_engine", "python"),
+                        exact = getattr(args, "exact_wordlist", False),
+                        token_cache = token_cache)
 
     def pristine(self, args):
 
@@ -242,6 +296,9 @@ section'client'
         if self.dbname == "mysql":
             raise NameError("Don't try to delete the mysql database")
         bookworm.db.query("DROP DATABASE IF EXISTS {}".format(self.dbname))
+        # The tables in the build record are gone now.
+        if os.path.exists(".bookworm/build/state.json"):
+            os.remove(".bookworm/build/state.json")
 
     def encoded(self, args):
         """
@@ -250,30 +307,113 @@ section'client'
         self.wordlist(args)
         self.derived_catalog(args)
 
-        for k in ['unigrams', 'bigrams', 'trigrams', 'quadgrams', 'completed']:
+        for k in ['unigrams', 'bigrams', 'trigrams', 'quadgrams', 'completed', 'nwords']:
             try:
                 os.makedirs(".bookworm/texts/encoded/{}".format(k))
             except FileExistsError:
                 pass
-        from .countManager import encode_words
-
-        if args.feature_counts:
-            for feature in args.feature_counts:
-                encode_words(".bookworm/texts/wordlist/wordlist.txt", feature)
+        from .countManager import encode_words, encode_cached, token_cache_matches, clear_token_cache, TOKEN_CACHE
+
+        engine = getattr(args, "count_engine", "python")
+        wordlist = ".bookworm/texts/wordlist/wordlist.txt"
+        if not args.feature_counts and token_cache_matches(TOKEN_CACHE, "input.txt", wordlist):
+            logging.info("Encoding from the token streams cached with the wordlist")
+            encode_cached(wordlist, TOKEN_CACHE)
+            if not getattr(args, "keep_token_cache", False):
+                # It's a second copy of the whole corpus, with no more use once encoded.
+                clear_token_cache(TOKEN_CACHE, recreate = False)
+        elif args.feature_counts:
+            encode_words(".bookworm/texts/wordlist/wordlist.txt", args.feature_counts, engine = engine)
         else:
-            encode_words(".bookworm/texts/wordlist/wordlist.txt", "input.txt")
+            encode_words(".bookworm/texts/wordlist/wordlist.txt", "input.txt", engine = engine)
 
     def all(self, args):
-        self.preDatabaseMetadata(args)
-        self.encoded(args)
-        self.database_wordcounts(args)
-        self.database_metadata(args)
+        """
+        Build the whole bookworm, running independent stages at once and
+        skipping the ones whose inputs haven't changed since the last build.
+        A report of the time each stage took goes in .bookworm/build/timing.txt.
+        """
+        from .build_graph import BuildGraph
+        BuildGraph(self.build_stages(args)).run()
+
+    def build_stages(self, args):
+        """
+        The stages of a full build, for `all`.
+        """
+        from functools import partial
+        from .build_graph import Stage
+        from .MetaParser import columnar_catalogs
+        from .countManager import TOKEN_CACHE
+
+        texts = ["input.txt"]
+        if args.feature_counts:
+            from .sharded_input import input_files
+            texts = input_files(args.feature_counts)
+        wordlist = ".bookworm/texts/wordlist/wordlist.txt"
+        textids = ".bookworm/metadata/textids.sqlite"
+        derived = ".bookworm/metadata/jsoncatalog_derived.txt"
+        encoded = ".bookworm/texts/encoded"
+        database = {"database": self.dbname}
+        partitioning = self.partitioning(args)
+        counts = dict(database, **partitioning)
+
+        def rows(*tablenames):
+            return [partial(table_rows, self.dbname, tablename) for tablename in tablenames]
+
+        # Every function here is picklable, so that stages can start under
+        # any multiprocessing start method.
+        return [
+            Stage("field_descriptions", self.guess_field_descriptions, outputs=["field_descriptions.json"]),
+            Stage("derived_catalog", partial(self.derived_catalog, args),
+                  requires=["field_descriptions"],
+                  inputs=["field_descriptions.json", "jsoncatalog.txt"] + columnar_catalogs,
+                  outputs=[derived, ".bookworm/metadata/field_descriptions_derived.json", textids],
+                  clean=[derived]),
+            Stage("wordlist", partial(self.wordlist, args),
+                  inputs=texts, outputs=[wordlist], clean=[wordlist, TOKEN_CACHE],
+                  options={"exact": getattr(args, "exact_wordlist", False),
+                           "cache_tokens": getattr(args, "cache_tokens", False)}),
+            Stage("encoded", partial(self.encoded, args),
+                  requires=["wordlist", "derived_catalog"],
+                  inputs=[wordlist, textids] + texts, outputs=[encoded], clean=[encoded]),
+            Stage("metadata_files", partial(self.write_metadata, args),
+                  requires=["derived_catalog"],
+                  inputs=[derived, ".bookworm/metadata/field_descriptions_derived.json", textids],
+                  outputs=[".bookworm/metadata/catalog.txt"]),
+            Stage("words_table", partial(load_tables, self.dbname, "load_word_list"),
+                  requires=["wordlist"], inputs=[wordlist], options=database,
+                  checks=rows("words")),
+            Stage("unigrams_table", partial(load_tables, self.dbname, "create_unigram_book_counts", **partitioning),
+                  requires=["encoded"], inputs=[encoded + "/unigrams"], options=counts,
+                  checks=rows("master_bookcounts")),
+            Stage("bigrams_table", partial(load_tables, self.dbname, "create_bigram_book_counts", **partitioning),
+                  requires=["encoded"], inputs=[encoded + "/bigrams"], options=counts,
+                  checks=rows("master_bigrams")),
+            Stage("database_metadata", partial(self.database_metadata, args),
+                  requires=["metadata_files", "words_table", "unigrams_table"],
+                  inputs=[".bookworm/metadata/*.txt", ".bookworm/metadata/*.json", encoded + "/nwords"],
+                  options=database,
+                  checks=rows("catalog", "fastcat_", "wordsheap_", "masterVariableTable"))
+        ]
+
+    def guess_field_descriptions(self):
+        """
+        Guess at field_descriptions.json, unless there already is one.
+        """
+        if not os.path.exists("field_descriptions.json"):
+            self.guessAtFieldDescriptions()
 
     def preDatabaseMetadata(self, args=None, **kwargs):
         import os
         if not os.path.exists("field_descriptions.json"):
             self.guessAtFieldDescriptions()
         self.derived_catalog(args)
+        self.write_metadata(args)
+
+    def write_metadata(self, args=None):
+        """
+        Write the catalog and the other metadata files that MySQL loads.
+        """
         import bookwormDB.CreateDatabase
         # Doesn't need a created database yet, just needs access
         # to some pieces.
@@ -407,13 +547,25 @@ section'client'
                 index = not cmd_args.no_index
                 newtable = not cmd_args.no_delete
             reverse_index = not cmd_args.no_reverse_index
-            if not (newtable and ingest and index):
+            if not (ingest and index):
                 logging.warn("database_wordcounts args not supported for bigrams yet.")
 
         Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname)
         Bookworm.load_word_list()
-        Bookworm.create_unigram_book_counts(newtable=newtable, ingest=ingest, index=index, reverse_index=reverse_index)
-        Bookworm.create_bigram_book_counts()
+        jobs = getattr(cmd_args, "jobs", 1)
+        partitioning = self.partitioning(cmd_args)
+        Bookworm.create_unigram_book_counts(newtable=newtable, ingest=ingest, index=index, reverse_index=reverse_index, jobs=jobs, **partitioning)
+        Bookworm.create_bigram_book_counts(newtable=newtable, **partitioning)
+
+    def partitioning(self, args=None):
+        """
+        How to partition the count tables: `--partition-by` or
+        `partition_by` in the [build] section of bookworm.cnf picks 'hash' or
+        'range', and `partitions` there sets how many (by default, 16).
+        """
+        partition_by = getattr(args, "partition_by", None) or self.build_options.get("partition_by")
+        partitions = int(self.build_options.get("partitions", 16))
+        return {"partition_by": partition_by, "partitions": partitions}
 
 class Extension(object):
 
@@ -471,7 +623,19 @@ def run_arguments():
 
 
     parser.add_argument("--feature-counts", action='append',
-                                 help="Use pre-calculated feature counts rather than tokenizing complete text on the fly. Supply any number of single files per count level like 'input.unigrams', 'input.bigrams', etc.")
+                                 help="Use pre-calculated feature counts rather than tokenizing complete text on the fly. Supply any number of files per count level like 'input.unigrams', 'input.bigrams', etc., or directories or glob patterns of them.")
+
+    parser.add_argument("--count-engine", choices=["python", "numpy"], default="python",
+                        help="How to count n-grams while tokenizing. 'numpy' packs n-grams into integer arrays, which is faster on long documents; both give identical output.")
+
+    parser.add_argument("--exact-wordlist", action="store_true", default=False,
+                        help="Count the vocabulary exactly, spilling sorted partial counts to disk and merging them, instead of with an approximate in-memory sketch. Slower, but deterministic on corpora larger than memory.")
+
+    parser.add_argument("--cache-tokens", action="store_true", default=False,
+                        help="While counting words for the wordlist, also save every document as an array of token ids, so that encoding doesn't have to tokenize the text a second time. Takes about as much disk space in .bookworm/texts/tokens as the input text itself, until encoding is done.")
+
+    parser.add_argument("--keep-token-cache", action="store_true", default=False,
+                        help="Don't delete the tokens saved by --cache-tokens once the texts are encoded.")
 
     parser.add_argument("--ngrams",nargs="+",default=["unigrams","bigrams"],help="What levels to parse with. Multiple arguments should be unquoted in spaces. This option currently does nothing.")
 
@@ -549,7 +713,7 @@ def run_arguments():
 
     word_ingest_parser = extensions_subparsers.add_parser("database_wordcounts",
                                                            help=getattr(BookwormManager, "database_wordcounts").__doc__)
-    word_ingest_parser.add_argument("--no-delete", action="store_true", help="Do not delete and rebuild the token tables. Useful for a partially finished ingest.")
+    word_ingest_parser.add_argument("--no-delete", action="store_true", help="Do not delete and rebuild the token tables: resume a partially finished ingest, skipping files already loaded.")
 
     word_ingest_parser.add_argument("--no-reverse-index", action="store_true", help="When creating the table, choose not to index bookid/wordid/counts. This is useful for really large builds. Because this is specified at table creation time, it does nothing with --no-delete or --index-only.")
 
@@ -557,6 +721,10 @@ def run_arguments():
 
     word_ingest_parser.add_argument("--index-only", action="store_true", help="Only re-enable keys. Supercedes other flags.")
 
+    word_ingest_parser.add_argument("--partition-by", choices=["hash", "range"], default=None, help="Create master_bookcounts and master_bigrams with native MySQL partitions, either by a hash of the (first) wordid or by ranges of bookids. The number of partitions is 'partitions' in the [build] section of bookworm.cnf (16 by default). Needs MariaDB or MySQL 5.7 or earlier, since MySQL 8.0 can't partition MyISAM tables.")
+
+    word_ingest_parser.add_argument("--jobs", "-j", type=int, default=1, help="Load the unigram counts over this many MySQL connections at once, each into its own partition of master_bookcounts (joined by a MERGE table), and rebuild each partition's keys in parallel. Pass the same number with --index-only.")
+
     # Bookworm prep targets that don't allow additional args
     for prep_arg in BookwormManager.__dict__.keys():
         extensions_subparsers.add_parser(prep_arg, help=getattr(BookwormManager, prep_arg).__doc__)
@@ -587,6 +755,11 @@ def run_arguments():
 
 
 
+    reshard_parser = subparsers.add_parser("reshard", help=getattr(BookwormManager, "reshard").__doc__)
+    reshard_parser.add_argument("input", help="The text or gzip file to recompress.")
+    reshard_parser.add_argument("--output", "-o", default=None, help="Where to write the new gzip file: by default, over a gzip input, or next to a text one with '.gz' added.")
+    reshard_parser.add_argument("--lines-per-member", type=int, default=100000, help="The number of lines in each gzip member.")
+
     # Configure the global server.
     configure_parser = subparsers.add_parser("config",help="Some helpers to configure a running bookworm, or to manage your server-wide configuration.")
     configure_parser.add_argument("target",help="The thing you want help configuring.",choices=["mysql", "mysql-info", "apache"])
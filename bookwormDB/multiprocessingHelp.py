@@ -24,6 +24,7 @@ def running_processes(workerlist):
             running = True
         else:
             code = worker.exitcode
-            if code > 0:
-                raise("Process died with code {}".format(code))
+            # Negative codes are deaths by signal, such as from the OOM killer.
+            if code != 0:
+                raise RuntimeError("Process died with code {}".format(code))
     return running
@@ -0,0 +1,255 @@
+import os
+import io
+import glob
+import gzip
+import zlib
+import logging
+
+"""
+Splits an input file into shards that separate worker processes can
+read independently, so that a corpus is scanned (and, for gzip,
+decompressed) only once in total rather than once per worker.
+
+A shard is a tuple of `(path, start, end)`, where `start` and `end` are
+byte offsets into the file on disk. `end` may be None, meaning 'to the end
+of the file.' A striped shard, `(path, start, end, stripe, stripes)`, holds
+only every `stripes`-th line of that range, starting from line `stripe`.
+
+Plain text files are split into newline-aligned byte ranges.
+
+Gzip files can only be entered at the start of a gzip member. Files made by
+concatenating gzip files (`cat a.gz b.gz > input.txt.gz`), or written with
+`write_gzip_shards`, have many members; a sidecar index at
+`input.txt.gz.idx` records which member offsets fall on line boundaries.
+The index is built with a single streaming pass the first time it's
+needed. A single-member gzip file can't be split into ranges, so unless the
+shards have to be in input order, it's striped instead: each worker
+decompresses the whole file but only parses its own share of the lines,
+as every worker did before inputs were sharded. Recompressing it with
+`bookworm reshard` (see `write_gzip_shards`) saves the repeated
+decompression.
+"""
+
+def plain_ranges(path, n):
+    """
+    Split a plain text file into (up to) n byte ranges, each of which
+    begins at the start of a line.
+    """
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, "rb") as fin:
+        for i in range(1, n):
+            fin.seek(int(size * i / n))
+            if starts[-1] >= fin.tell():
+                continue
+            # Move to the start of the next full line.
+            fin.readline()
+            position = fin.tell()
+            if position >= size:
+                break
+            if position > starts[-1]:
+                starts.append(position)
+    ends = starts[1:] + [size]
+    return list(zip(starts, ends))
+
+
+def index_location(path):
+    return path + ".idx"
+
+
+def gzip_member_index(path):
+    """
+    Return the compressed byte offsets of the gzip members in `path` that
+    begin at the start of a line. The list always begins with zero.
+
+    The result is cached in a sidecar file, which is rebuilt if it is
+    older than the gzip file itself.
+    """
+    idx = index_location(path)
+    if os.path.exists(idx) and os.path.getmtime(idx) >= os.path.getmtime(path):
+        with open(idx) as fin:
+            return [int(line) for line in fin if line.strip() != ""]
+
+    logging.info("Building gzip member index for {}".format(path))
+    offsets = [0]
+    consumed = 0
+    ends_with_newline = True
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(path, "rb") as fin:
+        while True:
+            block = fin.read(1024 * 1024)
+            if not block:
+                break
+            while block:
+                out = decompressor.decompress(block)
+                if out:
+                    ends_with_newline = out.endswith(b"\n")
+                if decompressor.eof:
+                    # A member ended partway through the block.
+                    leftover = decompressor.unused_data
+                    consumed += len(block) - len(leftover)
+                    if ends_with_newline:
+                        offsets.append(consumed)
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    block = leftover
+                else:
+                    consumed += len(block)
+                    block = b""
+    # The end of the last member is not the start of anything.
+    offsets = [o for o in offsets if o < consumed]
+    try:
+        with open(idx, "w") as fout:
+            for offset in offsets:
+                fout.write("{}\n".format(offset))
+    except OSError:
+        logging.warning("Unable to write gzip index to {}".format(idx))
+    if len(offsets) == 1:
+        logging.warning("{} is a single gzip member, so every process reading it has to "
+                        "decompress all of it. Recompress it with `bookworm reshard` "
+                        "to split it between them instead.".format(path))
+    return offsets
+
+
+def gzip_ranges(path, n):
+    """
+    Split a gzip file into (up to) n ranges of whole, line-aligned members.
+    """
+    offsets = gzip_member_index(path)
+    if len(offsets) <= n:
+        starts = offsets
+    else:
+        # Pick n members that fall closest to evenly spaced compressed offsets.
+        size = os.path.getsize(path)
+        starts = [0]
+        j = 0
+        for i in range(1, n):
+            target = size * i / n
+            while j < len(offsets) - 1 and offsets[j] < target:
+                j += 1
+            if offsets[j] > starts[-1]:
+                starts.append(offsets[j])
+    ends = starts[1:] + [None]
+    return list(zip(starts, ends))
+
+
+def input_files(spec):
+    """
+    Expand a filename, directory, or glob pattern (or a list of them)
+    into a sorted list of input files. Directories contribute every file
+    inside them, except hidden files and gzip index sidecars.
+    """
+    if isinstance(spec, str):
+        spec = [spec]
+    paths = []
+    for item in spec:
+        if os.path.isdir(item):
+            matches = [os.path.join(item, f) for f in os.listdir(item) if not f.startswith(".")]
+        elif os.path.exists(item):
+            matches = [item]
+        else:
+            matches = glob.glob(item)
+            if len(matches) == 0:
+                raise FileNotFoundError("No input files match {}".format(item))
+        paths.extend(sorted(m for m in matches if os.path.isfile(m) and not m.endswith(".idx")))
+    return paths
+
+
+def shards(paths, n, ordered=False):
+    """
+    Divide one or more input files into roughly n shards.
+
+    `paths` may be a single filename or a list of them. Returns a list of
+    (path, start, end) tuples, and striped ones for single-member gzip
+    files. With `ordered`, the shards are always in input order, so such a
+    file is left as one shard instead of striped.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    if len(paths) == 0:
+        return []
+    sizes = [max(os.path.getsize(p), 1) for p in paths]
+    total = sum(sizes)
+    output = []
+    for path, size in zip(paths, sizes):
+        # Apportion workers to files by size, but give every file at least one.
+        k = max(1, round(n * size / total))
+        if path.endswith(".gz"):
+            ranges = gzip_ranges(path, k)
+            if len(ranges) == 1 and not ordered:
+                # Striping past the number of cores only repeats the decompression.
+                stripes = min(k, os.cpu_count() or 1)
+                if stripes > 1:
+                    output.extend([(path, 0, None, stripe, stripes) for stripe in range(stripes)])
+                    continue
+        else:
+            ranges = plain_ranges(path, k)
+        for start, end in ranges:
+            output.append((path, start, end))
+    return output
+
+
+class _BoundedReader(io.RawIOBase):
+    """
+    A read-only file wrapper that stops after `length` bytes.
+    """
+    def __init__(self, fileobj, length=None):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if size <= 0:
+            return 0
+        data = self.fileobj.read(size)
+        buffer[:len(data)] = data
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.fileobj.close()
+        super().close()
+
+
+def read_shard(path, start=0, end=None, stripe=0, stripes=1):
+    """
+    Yield the lines (as strings, with line endings) in one shard of a file.
+    """
+    fin = open(path, "rb")
+    fin.seek(start)
+    length = None if end is None else end - start
+    raw = _BoundedReader(fin, length)
+    if path.endswith(".gz"):
+        binary = gzip.GzipFile(fileobj=io.BufferedReader(raw), mode="rb")
+    else:
+        binary = io.BufferedReader(raw)
+    try:
+        lines = io.TextIOWrapper(binary, encoding="utf-8")
+        if stripes > 1:
+            lines = (line for i, line in enumerate(lines) if i % stripes == stripe)
+        for line in lines:
+            yield line
+    finally:
+        binary.close()
+        raw.close()
+
+
+def write_gzip_shards(path, output, lines_per_member=100000):
+    """
+    Recompress a text or gzip file as a multi-member gzip file whose
+    members each begin at the start of a line, so that `shards` can split it.
+    """
+    with open(output, "wb") as fout:
+        buffer = []
+        for line in read_shard(path):
+            buffer.append(line)
+            if len(buffer) >= lines_per_member:
+                fout.write(gzip.compress("".join(buffer).encode("utf-8")))
+                buffer = []
+        if buffer:
+            fout.write(gzip.compress("".join(buffer).encode("utf-8")))
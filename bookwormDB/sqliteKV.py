@@ -14,6 +14,38 @@
 # Python implementation of the SQLiteKV store.
 
 import sqlite3
+import hashlib
+import os
+from functools import lru_cache
+from urllib.request import pathname2url
+from bisect import bisect_left
+import numpy as np
+
+# How much of a read-only database to memory-map.
+READ_MMAP_SIZE = 1024 * 1024 * 1024
+
+def batches(iterable, size):
+    """
+    Split any iterable into lists of (at most) `size` items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def key_hash(key):
+    """
+    A stable 64-bit hash of a key (unlike python's `hash`, the same in
+    every process). Other types are hashed as strings, as sqlite would
+    compare them against the text keys.
+    """
+    if not isinstance(key, str):
+        key = str(key)
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
 
 
 class KV:
@@ -24,15 +56,39 @@ class KV:
       * The `close` method has to be called after use.
       * The `delete` method is not yet implemented.
     """
-    def __init__(self, dbfile):
+    def __init__(self, dbfile, readonly=False, cache_size=0):
         """
         Open a connection to the SQLite file. If it doesn't exists, create it
         and add the needed tables.
+
+        readonly: open the file read-only (it must already exist), with a
+        large page cache and memory-mapped I/O, so that any number of
+        processes can read it at once without taking write locks.
+        cache_size: if positive, keep up to this many looked-up keys in an
+        LRU cache in front of `__getitem__`; see `cache_info`.
         """
         self.conn = None
-        self.conn = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.dbfile = dbfile
+        self.readonly = readonly
+        if readonly:
+            if not os.path.exists(dbfile):
+                raise FileNotFoundError(dbfile)
+            uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(dbfile)))
+            self.conn = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+            self.conn.execute("PRAGMA query_only=ON")
+            self.conn.execute("PRAGMA mmap_size={}".format(READ_MMAP_SIZE))
+            self.conn.execute("PRAGMA cache_size=-65536")
+        else:
+            self.conn = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
         self.conn.row_factory = sqlite3.Row
 
+        self.lookup = self._select
+        if cache_size > 0:
+            self.lookup = lru_cache(maxsize=cache_size)(self._select)
+
+        if readonly:
+            return
+
         tables = [dict(r)['name'] for r in self.conn.execute(
             "SELECT name FROM sqlite_master WHERE type='table'")]
 
@@ -48,10 +104,14 @@ class KV:
         """
         Properly close the database.
         """
-        self.conn.commit()
+        if not self.readonly:
+            self.conn.commit()
         self.conn.close()
                        
     def __getitem__(self, key):
+        return self.lookup(key)
+
+    def _select(self, key):
         rows = self.conn.execute("""SELECT ID FROM keys 
                                WHERE keys.key=(?)""", (key, ))
         row = rows.fetchone()
@@ -59,7 +119,219 @@ class KV:
             raise KeyError(key)
         return row['ID']
 
+    def cache_info(self):
+        """
+        Hits, misses, and size of the lookup cache (None without one).
+        Keys that aren't found aren't cached.
+        """
+        if self.lookup is self._select:
+            return None
+        return self.lookup.cache_info()
+
     def register(self, key):
         self.conn.execute("INSERT INTO keys(key) VALUES (?)",
                           (key, ))
 
+    def register_many(self, keys, batchsize=100000):
+        """
+        Register many keys, in order, in a single transaction.
+
+        Returns a tuple of an int64 array of every key's ID and a list of
+        the keys that were already registered (or repeated in `keys`),
+        which keep the ID they had first. Either way, the new keys get
+        consecutive IDs.
+
+        Into an empty table, the keys go through an unindexed staging
+        table first, so nothing about them is held in memory; see
+        `_bulk_load`. Otherwise each batch is checked against the
+        existing keys before it's inserted.
+        """
+        conn = self.conn
+        conn.commit()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Room to sort the keys when they're copied into the index.
+        conn.execute("PRAGMA cache_size=-262144")
+        first = (conn.execute("SELECT MAX(ID) FROM keys").fetchone()[0] or 0) + 1
+
+        with conn:
+            if first == 1:
+                return self._bulk_load(keys, batchsize)
+            ids = []
+            duplicates = []
+            next_id = first
+            for batch in batches(keys, batchsize):
+                found = self.get_many(batch)
+                new = []
+                batch_ids = []
+                for key in batch:
+                    if key in found:
+                        duplicates.append(key)
+                    else:
+                        found[key] = next_id + len(new)
+                        new.append(key)
+                    batch_ids.append(found[key])
+                conn.executemany("INSERT INTO keys(ID, key) VALUES (?, ?)",
+                                 zip(range(next_id, next_id + len(new)), new))
+                next_id += len(new)
+                ids.extend(batch_ids)
+        return np.array(ids, dtype=np.int64), duplicates
+
+    def _bulk_load(self, keys, batchsize):
+        """
+        Load keys into the empty `keys` table, inside the caller's
+        transaction.
+
+        Every key is numbered in order in `keys_load`, which has no index;
+        repeats are found afterwards with a GROUP BY, and all but the first
+        copy of each dropped. The rest are copied into `keys` in key order
+        (so the unique index is built in one pass), with IDs shifted down
+        over the dropped rows.
+        """
+        conn = self.conn
+        conn.execute("DROP TABLE IF EXISTS keys_load")
+        conn.execute("CREATE TABLE keys_load(ID INTEGER PRIMARY KEY, key TEXT NOT NULL)")
+        n = 0
+        for batch in batches(keys, batchsize):
+            conn.executemany("INSERT INTO keys_load(ID, key) VALUES (?, ?)",
+                             zip(range(n + 1, n + len(batch) + 1), batch))
+            n += len(batch)
+        ids = np.arange(1, n + 1, dtype=np.int64)
+
+        duplicates = []
+        removed = []
+        firsts = dict()
+        for row in conn.execute("""SELECT ID, key FROM keys_load WHERE key IN
+                                   (SELECT key FROM keys_load GROUP BY key HAVING COUNT(*) > 1)
+                                   ORDER BY ID"""):
+            id, key = row[0], row[1]
+            if key in firsts:
+                duplicates.append(key)
+                removed.append(id)
+                ids[id - 1] = firsts[key]
+            else:
+                firsts[key] = id
+        del firsts
+
+        if len(removed) > 0:
+            conn.execute("CREATE TEMP TABLE keys_removed(ID INTEGER PRIMARY KEY)")
+            conn.executemany("INSERT INTO keys_removed(ID) VALUES (?)", ((id,) for id in removed))
+            conn.execute("DELETE FROM keys_load WHERE ID IN (SELECT ID FROM keys_removed)")
+            conn.execute("""INSERT INTO keys(ID, key)
+                            SELECT ID - (SELECT COUNT(*) FROM keys_removed
+                                         WHERE keys_removed.ID < keys_load.ID), key
+                            FROM keys_load ORDER BY key""")
+            conn.execute("DROP TABLE keys_removed")
+            # Each ID, first copies included, moves down by the rows dropped before it.
+            ids -= np.searchsorted(np.array(removed, dtype=np.int64), ids)
+        else:
+            conn.execute("INSERT INTO keys(ID, key) SELECT ID, key FROM keys_load ORDER BY key")
+        conn.execute("DROP TABLE keys_load")
+        return ids, duplicates
+
+    def get_many(self, keys, chunksize=500):
+        """
+        Look up many keys at once. Returns a dict from each key that
+        exists to its ID; missing keys are left out.
+        """
+        keys = list(keys)
+        found = dict()
+        for i in range(0, len(keys), chunksize):
+            chunk = keys[i:i + chunksize]
+            q = "SELECT key, ID FROM keys WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            for row in self.conn.execute(q, chunk):
+                found[row['key']] = row['ID']
+        return found
+
+    def export(self, path=None):
+        """
+        Write every key's hash and ID to a sorted numpy file next to the
+        database, so that readers can load (or memory-map) the whole table
+        at once instead of querying one key at a time. The file is only
+        rewritten if the database has changed since it was made.
+
+        Returns the path to the file.
+        """
+        if path is None:
+            path = self.dbfile + ".hashes.npy"
+        modified = os.path.getmtime(self.dbfile)
+        if os.path.exists(self.dbfile + "-wal"):
+            # In WAL mode, recent writes may not have reached the main file yet.
+            modified = max(modified, os.path.getmtime(self.dbfile + "-wal"))
+        if os.path.exists(path) and os.path.getmtime(path) >= modified:
+            return path
+        hashes = []
+        ids = []
+        for key, id in self.conn.execute("SELECT key, ID FROM keys"):
+            hashes.append(key_hash(key))
+            ids.append(id)
+        table = np.array([hashes, ids], dtype=np.uint64).reshape(2, len(ids))
+        table = np.ascontiguousarray(table[:, np.argsort(table[0], kind="stable")])
+        tmp = "{}.{}.tmp.npy".format(path, os.getpid())
+        np.save(tmp, table)
+        os.replace(tmp, path)
+        return path
+
+    def frozen(self):
+        """
+        A read-only, in-memory copy of this table: see `FrozenKV`.
+        """
+        return FrozenKV(self.export(), fallback=self)
+
+
+class FrozenKV:
+    """
+    A read-only view of a KV table held as two sorted numpy arrays of
+    key hashes and IDs. The file is memory-mapped, so processes on
+    the same machine share one copy.
+
+    Lookups are a binary search rather than a SQL query. The (very rare)
+    keys whose 64-bit hashes collide are looked up in the original
+    database instead.
+    """
+    def __init__(self, path, fallback=None):
+        table = np.load(path, mmap_mode="r")
+        self.hashes = table[0]
+        self.ids = table[1]
+        self.fallback = fallback
+        # Single lookups are faster through plain memoryviews than numpy scalars.
+        self._hashes = memoryview(self.hashes).cast("B").cast("Q")
+        self._ids = memoryview(self.ids).cast("B").cast("Q")
+        duplicated = self.hashes[1:] == self.hashes[:-1]
+        self.collisions = set(self.hashes[1:][duplicated].tolist())
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __getitem__(self, key):
+        h = key_hash(key)
+        if h in self.collisions:
+            return self.fallback[key]
+        i = bisect_left(self._hashes, h)
+        if i >= len(self._hashes) or self._hashes[i] != h:
+            raise KeyError(key)
+        return self._ids[i]
+
+    def get_many(self, keys):
+        """
+        Look up many keys at once. Returns a dict from each key that
+        exists to its ID; missing keys are left out.
+        """
+        keys = list(keys)
+        if len(self.hashes) == 0:
+            return dict()
+        hashes = np.fromiter(map(key_hash, keys), dtype=np.uint64, count=len(keys))
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        hit = self.hashes[positions] == hashes
+        ids = self.ids[positions]
+        found = dict()
+        for key, h, is_hit, id in zip(keys, hashes.tolist(), hit.tolist(), ids.tolist()):
+            if h in self.collisions:
+                found.update(self.fallback.get_many([key]))
+            elif is_hit:
+                found[key] = id
+        return found
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
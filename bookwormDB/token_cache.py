@@ -0,0 +1,107 @@
+import os
+import json
+import logging
+import numpy as np
+from .tokenizer import count_id_ngrams, ngram_sizes, word_ids
+
+"""
+A cache of tokenized documents, so that a full build only has to
+tokenize the corpus once.
+
+While `create_counts` counts words for the wordlist, each worker can
+also write every document out as an array of integer token ids. The ids
+are provisional: they index a vocabulary local to that worker, since the
+final wordids aren't known until the wordlist is done. Afterwards
+`encode_cached` (in countManager) remaps each segment's vocabulary onto
+the wordlist with one lookup per distinct word, and writes the encoded
+unigram and bigram files without running the tokenizer again.
+
+A worker's cache is split into segments whenever its local vocabulary
+gets large, so that memory stays bounded. Each segment is a pair of files:
+
+    {name}.bin    int32 token ids for every document, end to end
+    {name}.json   the segment's vocabulary, filenames, and document bounds
+"""
+
+# Start a new segment once a worker has seen this many distinct tokens.
+SEGMENT_VOCAB_LIMIT = 2000000
+
+class TokenCacheWriter(object):
+    """
+    Writes the token streams for a single worker.
+    """
+    def __init__(self, directory, worker):
+        self.directory = directory
+        self.worker = worker
+        self.segment = -1
+        self.fout = None
+        self.new_segment()
+
+    def new_segment(self):
+        self.close()
+        self.segment += 1
+        self.name = os.path.join(self.directory, "{:05d}-{:04d}".format(self.worker, self.segment))
+        self.fout = open(self.name + ".bin", "wb")
+        self.vocab = dict()
+        self.filenames = []
+        self.bounds = [0]
+
+    def add(self, filename, tokens):
+        vocab = self.vocab
+        if len(vocab) > SEGMENT_VOCAB_LIMIT:
+            self.new_segment()
+            vocab = self.vocab
+        ids = np.fromiter((vocab.setdefault(t, len(vocab)) for t in tokens),
+                          dtype=np.int32, count=len(tokens))
+        self.fout.write(ids.tobytes())
+        self.filenames.append(filename)
+        self.bounds.append(self.bounds[-1] + len(ids))
+
+    def close(self):
+        if self.fout is None:
+            return
+        self.fout.close()
+        with open(self.name + ".json", "w") as fout:
+            json.dump({
+                "vocab": list(self.vocab),
+                "filenames": self.filenames,
+                "bounds": self.bounds
+            }, fout)
+        self.fout = None
+
+
+def cache_segments(directory):
+    """
+    The names of all complete segments in a token cache.
+    """
+    return sorted(f[:-5] for f in os.listdir(directory) if f.endswith(".json"))
+
+
+class CachedTokens(object):
+    """
+    A tokenizer-like view of one cached document, for `tokenBatches.encodeRow`.
+
+    `remap` translates the segment's provisional ids to wordids (-1 for
+    words not in the wordlist).
+    """
+    def __init__(self, ids, remap):
+        self.ids = ids
+        self.remap = remap
+
+    def wordid_counts(self, level):
+        grams, counts = count_id_ngrams(self.ids, ngram_sizes[level], len(self.remap))
+        return self.remap[grams], counts
+
+
+def read_segment(name, dictionary):
+    """
+    Yield (filename, CachedTokens) for every document in a segment.
+    """
+    with open(name + ".json") as fin:
+        meta = json.load(fin)
+    remap = word_ids(dictionary, meta["vocab"])
+    ids = np.fromfile(name + ".bin", dtype=np.int32)
+    bounds = meta["bounds"]
+    logging.debug("Encoding {} cached documents from {}".format(len(meta["filenames"]), name))
+    for filename, start, end in zip(meta["filenames"], bounds[:-1], bounds[1:]):
+        yield filename, CachedTokens(ids[start:end], remap)
@@ -5,12 +5,13 @@ import random
 import sys
 import os
 from .sqliteKV import KV
+from .vocabulary import Vocabulary, build_vocabulary
 import time
 import logging
 import numpy as np
-from pandas import read_csv
-from io import StringIO
-import re
+# The default word regex uses unicode classes (\p{Z}) that only the
+# `regex` module understands; it is imported on demand in `tokenize`.
+re = None
 
 """
 This section does a lot of work on tokenizing and aggregating wordcounts.
@@ -43,6 +44,55 @@ def wordRegex():
     return bigregex
 
 
+# The n-gram length behind each count type.
+ngram_sizes = {"words": 1, "unigrams": 1, "bigrams": 2, "trigrams": 3, "quadgrams": 4}
+
+def ngram_id_counts(tokens, n):
+    """
+    The numpy counting engine.
+
+    Maps each token to a document-local integer id once, packs every
+    n-gram into a single int64 key, and counts the keys with np.unique.
+
+    Returns a tuple of (vocab, grams, counts): `vocab` is the list of
+    distinct tokens, `grams` an (k, n) array of indices into vocab, and
+    `counts` a length k array. N-grams are in order of first appearance,
+    which is the same order the dict-based engine produces.
+    """
+    vocab = list(dict.fromkeys(tokens))
+    index = dict(zip(vocab, range(len(vocab))))
+    ids = np.fromiter(map(index.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+    grams, counts = count_id_ngrams(ids, n, len(vocab), first_appearance=True)
+    return vocab, grams, counts
+
+def count_id_ngrams(ids, n, nvocab, first_appearance=False):
+    """
+    Count the n-grams in an array of integer token ids in [0, nvocab).
+
+    Returns (grams, counts), in order of first appearance. If
+    `first_appearance` is set, the caller promises that ids were assigned
+    in order of first appearance, which makes unigrams trivial.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    m = len(ids) - n + 1
+    if m <= 0:
+        return np.zeros((0, n), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if n == 1 and first_appearance:
+        return np.arange(nvocab, dtype=np.int64)[:, None], np.bincount(ids, minlength=nvocab)
+    bits = max(1, (nvocab - 1).bit_length())
+    if bits * n <= 63:
+        keys = ids[:m].copy()
+        for i in range(1, n):
+            keys = (keys << bits) | ids[i:i + m]
+        _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    else:
+        # Too many distinct tokens to pack into one integer.
+        stacked = np.stack([ids[i:i + m] for i in range(n)], axis=1)
+        _, first, counts = np.unique(stacked, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    grams = ids[first[order][:, None] + np.arange(n)]
+    return grams, counts[order]
+
 def readDictionaryFile(prefix=""):
     look = dict()
     for line in open(prefix + ".bookworm/texts/wordlist/wordlist.txt"):
@@ -51,10 +101,27 @@ def readDictionaryFile(prefix=""):
         look[k] = v
     return look
 
+def readVocabulary(prefix=""):
+    """
+    The memory-mapped equivalent of `readDictionaryFile`, shared
+    between processes through the page cache.
+    """
+    path = build_vocabulary(prefix + ".bookworm/texts/wordlist/wordlist.txt")
+    return Vocabulary(path)
+
+def word_ids(dictionary, words):
+    """
+    Integer wordids for a list of words, with -1 for words not in the dictionary.
+    """
+    if isinstance(dictionary, Vocabulary):
+        return dictionary.ids(words)
+    return np.array([int(dictionary.get(word, -1)) for word in words], dtype=np.int64)
+
 def readIDfile(prefix=""):
     if not os.path.exists(".bookworm/metadata/textids.sqlite"):
         raise FileNotFoundError("No textids DB: run `bookworm build textids`")
-    return KV(prefix + ".bookworm/metadata/textids.sqlite")
+    # Only read here, so that many processes can share it.
+    return KV(prefix + ".bookworm/metadata/textids.sqlite", readonly=True)
 
 class tokenBatches(object):
     """
@@ -70,13 +137,17 @@ class tokenBatches(object):
     with 3-byte integer encoding for wordid and bookid.
     """
     
-    def __init__(self, levels=["unigrams","bigrams"]):
+    def __init__(self, levels=["unigrams","bigrams"], engine="python"):
         """
         
         mode: 'encode' (write files out)
+        engine: 'python' (count n-grams in a dict) or 'numpy'
+          (count them as packed integer arrays: see `ngram_id_counts`).
+          Both produce identical output.
         """
         self.id = '%030x' % random.randrange(16**30)
         self.levels=levels
+        self.engine = engine
 
         # placeholder to alert that createOutputFiles must be run.
         self.completedFile = None
@@ -86,10 +157,17 @@ class tokenBatches(object):
         self.outputFiles = dict()
         for level in self.levels:
             self.outputFiles[level] = open(".bookworm/texts/encoded/{}/{}.txt".format(level, self.id),"w")
+        # The word count of each document, loaded straight into `catalog.nwords`
+        # so that it doesn't have to be summed from master_bookcounts.
+        self.nwordsFile = None
+        if "unigrams" in self.levels:
+            self.nwordsFile = open(".bookworm/texts/encoded/nwords/{}.txt".format(self.id),"w")
         
     def attachDictionaryAndID(self):
-        self.dictionary = readDictionaryFile()
-        self.IDfile = readIDfile()
+        self.dictionary = readVocabulary()
+        # Load every filename's bookid at once rather than
+        # running a query for each document.
+        self.IDfile = readIDfile().frozen()
 
 
     def close(self):
@@ -101,6 +179,8 @@ class tokenBatches(object):
             self.completedFile.close()
             for v in self.outputFiles.values():
                 v.close()
+            if self.nwordsFile is not None:
+                self.nwordsFile.close()
         
     def encodeRow(self,
                   filename,
@@ -116,8 +196,7 @@ class tokenBatches(object):
             self.createOutputFiles()
             self.attachDictionaryAndID()
             
-        #The dictionary and ID lookup tables should be pre-attached.
-        dictionary = self.dictionary
+        #The ID lookup table should be pre-attached.
         IDfile = self.IDfile
 
         levels = None
@@ -149,25 +228,21 @@ class tokenBatches(object):
 
         for level in self.levels:
             outputFile = self.outputFiles[level]
-            output = []
-
-            counts = tokenizer.counts(level)
-
-            for wordset, count in counts.items():
-                skip = False
-                wordList = []
-                for word in wordset:
-                    try:
-                        wordList.append(dictionary[word])
-                    except KeyError:
-                        """
-                        if any of the words to be included is not in the dictionary,
-                        we don't include the whole n-gram in the counts.
-                        """
-                        skip = True                        
-                if not skip:
-                    wordids = "\t".join(wordList)
-                    output.append("{}\t{}\t{}".format(int(textid), wordids, count))
+
+            if hasattr(tokenizer, "wordid_counts"):
+                # Cached token streams are already in wordids.
+                grams, counts = tokenizer.wordid_counts(level)
+                output = self.formatIdCounts(textid, grams, counts)
+            elif self.engine == "numpy" and hasattr(tokenizer, "id_counts"):
+                output = self.encodeIdCounts(textid, tokenizer, level)
+            else:
+                output = self.encodeCounts(textid, tokenizer.counts(level))
+
+            if level == "unigrams" and self.nwordsFile is not None:
+                # Only words in the wordlist, as in SUM(count) over master_bookcounts.
+                nwords = sum(int(line.rsplit("\t", 1)[1]) for line in output)
+                if nwords > 0:
+                    self.nwordsFile.write("{}\t{}\n".format(int(textid), nwords))
 
             try:
                 if len(output) > 0:
@@ -180,6 +255,52 @@ class tokenBatches(object):
         if write_completed:
             self.completedFile.write(filename + "\n")
 
+    def encodeCounts(self, textid, counts):
+        """
+        Format a dict of ngram counts as lines of `bookid wordid(s) count`.
+        """
+        dictionary = self.dictionary
+        output = []
+
+        for wordset, count in counts.items():
+            skip = False
+            wordList = []
+            for word in wordset:
+                try:
+                    wordList.append(dictionary[word])
+                except KeyError:
+                    """
+                    if any of the words to be included is not in the dictionary,
+                    we don't include the whole n-gram in the counts.
+                    """
+                    skip = True                        
+            if not skip:
+                wordids = "\t".join(wordList)
+                output.append("{}\t{}\t{}".format(int(textid), wordids, count))
+        return output
+
+    def encodeIdCounts(self, textid, tokenizer, level):
+        """
+        The numpy engine's version of `encodeCounts`: each distinct token
+        is looked up in the dictionary once, rather than once per n-gram.
+        """
+        vocab, grams, counts = tokenizer.id_counts(level)
+        wordids = word_ids(self.dictionary, vocab)
+        return self.formatIdCounts(textid, wordids[grams], counts)
+
+    def formatIdCounts(self, textid, grams, counts):
+        """
+        Format an array of n-grams as wordids (-1 for words not in
+        the dictionary) and their counts as encoded lines.
+        """
+        if len(grams) == 0:
+            return []
+        # As above, skip n-grams that include any word not in the dictionary.
+        keep = (grams >= 0).all(axis=1)
+        rows = np.column_stack([grams[keep], counts[keep]]).tolist()
+        template = "{}\t".format(int(textid)) + "\t".join(["{}"] * (grams.shape[1] + 1))
+        return [template.format(*row) for row in rows]
+
 class Tokenizer(object):
     """
     A tokenizer is initialized with a single text string.
@@ -257,8 +378,22 @@ class Tokenizer(object):
         self.tokenize()
         return self.tokens
     
-    def counts(self, whichType):
-        
+    def id_counts(self, whichType):
+        """
+        Counts for the numpy engine: see `ngram_id_counts`.
+        """
+        self.tokenize()
+        return ngram_id_counts(self.tokens, ngram_sizes[whichType])
+
+    def counts(self, whichType, engine="python"):
+
+        if engine == "numpy" and whichType in ngram_sizes:
+            vocab, grams, counts = self.id_counts(whichType)
+            if whichType == "words":
+                return dict(zip(vocab, counts.tolist()))
+            return dict(zip([tuple([vocab[i] for i in gram]) for gram in grams.tolist()],
+                            counts.tolist()))
+
         count = dict()
         for gram in getattr(self,whichType)():
             try:
@@ -268,27 +403,75 @@ class Tokenizer(object):
         return count
 
 
+def parse_count_block(texts):
+    """
+    Parse a block of pre-tokenized documents at once.
+
+    Each text is a set of `word,count` pairs separated by form feeds ('\f'),
+    as in a '.unigrams' or '.bigrams' feature-count file. Words may be
+    double-quoted CSV-style if they contain a comma.
+
+    Returns (words, counts, bounds): a flat list of words, an int64 array of
+    their counts, and an array of len(texts) + 1 offsets such that
+    document i is words[bounds[i]:bounds[i + 1]].
+    """
+    pairs = []
+    lengths = []
+    for text in texts:
+        split = text.split("\f")
+        pairs.extend(split)
+        lengths.append(len(split))
+    words, _, counts = zip(*[pair.rpartition(",") for pair in pairs]) if pairs else ((), (), ())
+    words = np.array(words, dtype=object)
+    counts = np.array(counts, dtype=object)
+    # Blank records (for instance, from doubled form feeds) are skipped.
+    keep = counts != ""
+    document = np.repeat(np.arange(len(texts)), lengths)[keep]
+    words = words[keep].tolist()
+    counts = counts[keep].astype(str).astype(np.int64)
+    for i, word in enumerate(words):
+        if word.startswith('"') and word.endswith('"') and len(word) > 1:
+            words[i] = word[1:-1].replace('""', '"')
+    bounds = np.searchsorted(document, np.arange(len(texts) + 1))
+    return words, counts, bounds
+
+
 class PreTokenized(object):
     """
     This class is a little goofy: it mimics the behavior of a tokenizer
     one data that's already been tokenized by something like
     Google Ngrams or JStor Data for Research.
+
+    Parsing many documents at once through `PreTokenized.batch` is much
+    faster than creating them one at a time.
     """
 
     def __init__(self, csv_string, level):
-        f = read_csv(StringIO(csv_string),
-                     lineterminator = "\f",
-                     # Ugh--want 'NA' to be a word.
-                     dtype = {'word': str, 'counts': np.int},
-                     keep_default_na=False,
-                     names = ["word", "counts"])
+        words, counts, _ = parse_count_block([csv_string])
+        self.set_counts(words, counts, level)
+
+    def set_counts(self, words, counts, level):
         self.level = level
+        counts = counts.tolist()
         if level == 'words':
-            self.output = dict(zip(f.word, f.counts))
+            self.output = dict(zip(words, counts))
         else:
-            self.output = dict(zip([tuple(w.split(" ")) for w in f.word], f.counts))
+            self.output = dict(zip([tuple(w.split(" ")) for w in words], counts))
+
+    @classmethod
+    def batch(cls, texts, level):
+        """
+        Parse a list of documents, returning a PreTokenized for each.
+        """
+        words, counts, bounds = parse_count_block(texts)
+        output = []
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            tokenizer = cls.__new__(cls)
+            tokenizer.set_counts(words[start:end], counts[start:end], level)
+            output.append(tokenizer)
+        return output
             
-    def counts(self,level):
+    def counts(self, level, engine="python"):
         if level != self.level:
             raise
         return self.output
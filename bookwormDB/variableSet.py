@@ -8,7 +8,95 @@ import re
 from MySQLdb import escape_string
 import logging
 import subprocess
+import queue
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from .sqliteKV import KV
+from .multiprocessingHelp import mp_stats
+from .sharded_input import shards, read_shard
+from .field_profile import profile_file, profile_lines, guess_description, HyperLogLog, value_hashes
+from itertools import islice
+
+# Roughly how much of the metadata file each worker formats at a time.
+METADATA_CHUNK_BYTES = 16 * 1024 * 1024
+
+# How many MySQL connections `loadMetadata` builds tables over at once.
+LOAD_CONNECTIONS = 4
+
+# Past this many distinct values a field's ID needs at least a MEDIUMINT,
+# and only whether it needs an INT is left to decide; so `DistinctValues`
+# stops keeping the values themselves and estimates the count instead.
+DISTINCT_LIMIT = 65536
+
+# An estimated count of distinct values is raised by this much, well past
+# the error of a HyperLogLog with 2**14 registers (about 0.8%), so that a
+# field is never given too small an ID type.
+DISTINCT_ERROR_MARGIN = 0.05
+
+class DistinctValues(object):
+    """
+    The number of distinct values of a categorical field, and the length
+    of the longest, in bounded memory: the values are kept in a set up to
+    DISTINCT_LIMIT, and after that only in a HyperLogLog.
+    """
+    def __init__(self):
+        self.values = set()
+        self.sketch = None
+        self.pending = []
+        self.maxlength = 0
+
+    def add(self, value):
+        self.maxlength = max(self.maxlength, len(value))
+        if self.sketch is None:
+            self.values.add(value)
+            if len(self.values) > DISTINCT_LIMIT:
+                self.estimate_from_here()
+        else:
+            self.pending.append(value)
+            if len(self.pending) >= 100000:
+                self.flush()
+
+    def estimate_from_here(self):
+        self.sketch = HyperLogLog(14)
+        self.pending.extend(self.values)
+        self.values = set()
+        self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.sketch.add_hashes(value_hashes(self.pending))
+            self.pending = []
+
+    def update(self, other):
+        """
+        Add in the values from another chunk.
+        """
+        self.maxlength = max(self.maxlength, other.maxlength)
+        if other.sketch is None:
+            for value in other.values:
+                self.add(value)
+            return
+        if self.sketch is None:
+            self.estimate_from_here()
+        self.flush()
+        other.flush()
+        self.sketch.merge(other.sketch)
+
+    def count(self):
+        """
+        The exact count, or past DISTINCT_LIMIT an estimate that errs high.
+        """
+        if self.sketch is None:
+            return len(self.values)
+        self.flush()
+        estimate = self.sketch.estimate() * (1 + DISTINCT_ERROR_MARGIN)
+        return max(int(estimate), DISTINCT_LIMIT + 1)
+
+    def __getstate__(self):
+        # Sent back from the worker processes.
+        if self.sketch is not None:
+            self.flush()
+        return dict(vars(self))
 
 def to_unicode(obj):
     if isinstance(obj, bytes):
@@ -17,6 +105,23 @@ def to_unicode(obj):
         obj = str(obj)
     return obj
 
+def stats_location(catalogLocation):
+    return os.path.splitext(catalogLocation)[0] + ".stats.json"
+
+def read_metadata_stats(catalogLocation):
+    """
+    Read the stats that `writeMetadata` saved alongside a metadata file, or
+    return None if there are none as new as the file itself.
+    """
+    location = stats_location(catalogLocation)
+    if not os.path.exists(location) or not os.path.exists(catalogLocation):
+        return None
+    if os.path.getmtime(location) < os.path.getmtime(catalogLocation):
+        logging.warning("Ignoring {}, which is older than {}".format(location, catalogLocation))
+        return None
+    with open(location) as fin:
+        return json.load(fin)
+
 def splitMySQLcode(string):
     
     """
@@ -33,36 +138,6 @@ def splitMySQLcode(string):
     return output
 
 
-def guessBasedOnNameAndContents(metadataname,dictionary):
-    """
-    This makes a guess based on the data field's name and type.
-    CUrrently it assumes everything is categorical; that can really chunk out on some text fields, but works much better for importing csvs. Probably we want to take some other things into account as well.
-    """
-    description = {"field":metadataname,"datatype":"categorical","type":"character","unique":True}
-
-    example = list(dictionary.keys())[0]
-
-    if type(example) == int:
-        description["type"] = "integer"
-
-    if type(example) == list:
-        description["unique"] = False
-
-    if metadataname == "searchstring":
-        return {"datatype": "searchstring", "field": "searchstring", "unique": True, "type": "text"}
-
-    if re.search("date",metadataname) or re.search("time",metadataname):
-        description["datatype"] = "time"
-
-    values = [dictionary[key] for key in dictionary]
-    averageNumberOfEntries = sum(values)/ len(values)
-
-    if averageNumberOfEntries > 2:
-        description["datatype"] = "categorical"
-
-    return description
-
-
 class dataField(object):
     """
     This define a class that supports a data field from a json definition.
@@ -85,6 +160,12 @@ class dataField(object):
         for key in definition.keys():
             vars(self)[key] = definition[key]
         self.dbToPutIn = dbToPutIn
+        # Counts from `writeMetadata` (see `variableSet.setStats`), which
+        # save a scan of the table wherever they're available.
+        self.stats = None
+        # Each variable builds its tables through its own scratch table,
+        # so that several can be built at once.
+        self.tmpTable = "%s__tmp" % self.field
 
         #ordinarily, a column has no alias other than itself.
         self.alias = self.field
@@ -126,6 +207,13 @@ class dataField(object):
         val += "\n\tuniqueness: {}".format(self.unique)            
         return val
     
+    def __getstate__(self):
+        # Sent to worker processes without the connection or open output file.
+        state = dict(vars(self))
+        state["dbToPutIn"] = None
+        state.pop("output", None)
+        return state
+
     def slowSQL(self, withIndex=False):
         """
         This returns something like "author VARCHAR(255)",
@@ -180,11 +268,12 @@ class dataField(object):
         else:
             return None
 
-    def buildDiskTable(self,fileLocation="default"):
+    def buildDiskTable(self,fileLocation="default",db=None):
         """
         Builds a disk table for a nonunique variable.
         """
-        db = self.dbToPutIn
+        if db is None:
+            db = self.dbToPutIn
         dfield = self
 
         if fileLocation == "default":
@@ -206,40 +295,48 @@ class dataField(object):
         # cursor = db.query("""SELECT count(*) FROM """ + dfield.field + """Disk""")
         db.query("ALTER TABLE " + dfield.field + "Disk ENABLE KEYS")
 
-    def build_ID_and_lookup_tables(self):
-        IDcode = self.buildIdTable()
+    def build_ID_and_lookup_tables(self, db=None):
+        if db is None:
+            db = self.dbToPutIn
+        IDcode = self.buildIdTable(db=db)
         for query in splitMySQLcode(IDcode):
-            self.dbToPutIn.query(query)
-        for query in splitMySQLcode(self.fastLookupTableIfNecessary("MYISAM")):
-            self.dbToPutIn.query(query)
-        for query in splitMySQLcode(self.fastSQLTable("MYISAM")):
-            self.dbToPutIn.query(query)
+            db.query(query)
+        for query in splitMySQLcode(self.fastLookupTableIfNecessary("MYISAM", db=db)):
+            db.query(query)
+        for query in splitMySQLcode(self.fastSQLTable("MYISAM", db=db)):
+            db.query(query)
 
-    def fastLookupTableIfNecessary(self, engine="MEMORY"):
+    def fastLookupTableIfNecessary(self, engine="MEMORY", db=None):
 
         """
         This uses the already-created ID table to create a memory lookup.
         """
+        if db is None:
+            db = self.dbToPutIn
         self.engine = engine
         if self.datatype == 'categorical':
             logging.debug("Creating a memory lookup table for " + self.field)
-            self.setIntType()
-            self.maxlength = self.dbToPutIn.query("SELECT MAX(CHAR_LENGTH(%(field)s)) FROM %(field)s__id" % self.__dict__)
-            self.maxlength = self.maxlength.fetchall()[0][0]
+            self.setIntType(db)
+            if self.stats is not None:
+                # The ID table holds at most 255 characters of any value.
+                self.maxlength = min(self.stats["maxlength"], 255)
+            else:
+                self.maxlength = db.query("SELECT MAX(CHAR_LENGTH(%(field)s)) FROM %(field)s__id" % self.__dict__)
+                self.maxlength = self.maxlength.fetchall()[0][0]
             self.maxlength = max([self.maxlength,1])
-            code = """DROP TABLE IF EXISTS tmp;
-                   CREATE TABLE tmp (%(field)s__id %(intType)s ,PRIMARY KEY (%(field)s__id),
+            code = """DROP TABLE IF EXISTS %(tmpTable)s;
+                   CREATE TABLE %(tmpTable)s (%(field)s__id %(intType)s ,PRIMARY KEY (%(field)s__id),
                          %(field)s VARCHAR (%(maxlength)s) ) ENGINE=%(engine)s
                     SELECT %(field)s__id,%(field)s FROM %(field)s__id;""" % self.__dict__
             tname = self.field+"Lookup"
             if engine=="MYISAM":
                 tname += "_"
 
-            code += "DROP TABLE IF EXISTS {}; RENAME TABLE tmp to {}".format(tname,tname)
+            code += "DROP TABLE IF EXISTS {}; RENAME TABLE {} to {}".format(tname,self.tmpTable,tname)
             return code
         return ""
 
-    def fastSQLTable(self,engine="MEMORY"):
+    def fastSQLTable(self,engine="MEMORY",db=None):
         #setting engine to another value will create these tables on disk.
         queries = ""
         self.engine = engine
@@ -249,14 +346,14 @@ class dataField(object):
         if self.unique and self.anchor=="bookid":
             pass #when it has to be part of a larger set
         if not self.unique and self.datatype == 'categorical':
-            self.setIntType()
-            queries += """DROP TABLE IF EXISTS tmp;"""
-            queries += """CREATE TABLE tmp (%(anchor)s %(anchorType)s , INDEX (%(anchor)s),%(field)s__id %(intType)s ) ENGINE=%(engine)s; """ % self.__dict__
+            self.setIntType(db)
+            queries += """DROP TABLE IF EXISTS %(tmpTable)s;""" % self.__dict__
+            queries += """CREATE TABLE %(tmpTable)s (%(anchor)s %(anchorType)s , INDEX (%(anchor)s),%(field)s__id %(intType)s ) ENGINE=%(engine)s; """ % self.__dict__
             if engine=="MYISAM":
-                queries += "INSERT INTO tmp SELECT %(anchor)s ,%(field)s__id FROM %(field)s__id JOIN %(field)sDisk USING (%(field)s); " % self.__dict__
+                queries += "INSERT INTO %(tmpTable)s SELECT %(anchor)s ,%(field)s__id FROM %(field)s__id JOIN %(field)sDisk USING (%(field)s); " % self.__dict__
             elif engine=="MEMORY":
-                queries += "INSERT INTO tmp SELECT * FROM {}_; ".format(tname)
-            queries += "DROP TABLE IF EXISTS {}; RENAME TABLE tmp TO {}; ".format(tname,tname)
+                queries += "INSERT INTO {} SELECT * FROM {}_; ".format(self.tmpTable,tname)
+            queries += "DROP TABLE IF EXISTS {}; RENAME TABLE {} TO {}; ".format(tname,self.tmpTable,tname)
             
         if self.datatype == 'categorical' and self.unique:
             pass
@@ -314,12 +411,17 @@ class dataField(object):
 
         return mydict
 
-    def setIntType(self):
+    def setIntType(self, db=None):
+        if db is None:
+            db = self.dbToPutIn
         try:
             alreadyExists = self.intType
         except AttributeError:
-            cursor = self.dbToPutIn.query("SELECT count(DISTINCT "+ self.field + ") FROM " + self.table)
-            self.nCategories = cursor.fetchall()[0][0]
+            if self.stats is not None:
+                self.nCategories = self.stats["distinct"]
+            else:
+                cursor = db.query("SELECT count(DISTINCT "+ self.field + ") FROM " + self.table)
+                self.nCategories = cursor.fetchall()[0][0]
             self.intType = "INT UNSIGNED"
             if self.nCategories <= 16777215:
                 self.intType = "MEDIUMINT UNSIGNED"
@@ -328,7 +430,7 @@ class dataField(object):
             if self.nCategories <= 255:
                 self.intType = "TINYINT UNSIGNED"
 
-    def buildIdTable(self, minimum_occurrence_rate = 1/100000):
+    def buildIdTable(self, minimum_occurrence_rate = 1/100000, db=None):
 
         """
         This builds an integer crosswalk ID table with a field that stores categorical
@@ -344,19 +446,25 @@ class dataField(object):
         """
         #First, figure out how long the ID table has to be and make that into a datatype.
         #Joins and groups are slower the larger the field grouping on, so this is worth optimizing.
-        self.setIntType()
+        if db is None:
+            db = self.dbToPutIn
+        self.setIntType(db)
 
-        returnt = "DROP TABLE IF EXISTS tmp;\n\n"
+        returnt = "DROP TABLE IF EXISTS %(tmpTable)s;\n\n" % self.__dict__
 
-        returnt += "CREATE TABLE tmp ENGINE=MYISAM SELECT  %(field)s,count(*) as count FROM %(table)s GROUP BY %(field)s;\n\n" % self.__dict__
+        returnt += "CREATE TABLE %(tmpTable)s ENGINE=MYISAM SELECT  %(field)s,count(*) as count FROM %(table)s GROUP BY %(field)s;\n\n" % self.__dict__
 
         # XXXX to fix
         # Hardcoding this for now at one per 100K in the method definition. Could be user-set.
-        n_documents = self.dbToPutIn.query("SELECT COUNT(*) FROM catalog").fetchall()[0][0]        
+        catalog_stats = read_metadata_stats(".bookworm/metadata/catalog.txt")
+        if catalog_stats is not None:
+            n_documents = catalog_stats["rows"]
+        else:
+            n_documents = db.query("SELECT COUNT(*) FROM catalog").fetchall()[0][0]
         self.minimum_count = round(n_documents*minimum_occurrence_rate)
         # XXXX            
         
-        returnt +="DELETE FROM tmp WHERE count < %(minimum_count)s;" % self.__dict__
+        returnt +="DELETE FROM %(tmpTable)s WHERE count < %(minimum_count)s;" % self.__dict__
 
         returnt += "DROP TABLE IF EXISTS %(field)s__id;\n\n" % self.__dict__
 
@@ -365,10 +473,10 @@ class dataField(object):
                       %(field)s VARCHAR (255), INDEX (%(field)s, %(field)s__id), %(field)s__count MEDIUMINT UNSIGNED);\n\n""" % self.__dict__
 
         returnt += """INSERT INTO %(field)s__id (%(field)s,%(field)s__count)
-                      SELECT %(field)s,count FROM tmp LEFT JOIN %(field)s__id USING (%(field)s) WHERE %(field)s__id.%(field)s__id IS NULL
+                      SELECT %(field)s,count FROM %(tmpTable)s LEFT JOIN %(field)s__id USING (%(field)s) WHERE %(field)s__id.%(field)s__id IS NULL
                       ORDER BY count DESC;\n\n""" % self.__dict__
 
-        returnt += """DROP TABLE tmp;\n\n"""
+        returnt += """DROP TABLE %(tmpTable)s;\n\n""" % self.__dict__
 
         self.idCode = "%s__id" % self.field
         return returnt
@@ -521,8 +629,27 @@ class variableSet(object):
                 continue
             self.variables.append(dataField(item,self.db,anchor=anchorField,table=self.tableName,fasttab=self.fastName))
 
+        self.setStats(read_metadata_stats(self.catalogLocation))
+
     def __repr__(self):
         return "A variable set of {} objects".format(len(self.variables))
+
+    def __getstate__(self):
+        # Sent to worker processes (see `initMetadataWorker`) without the connection.
+        state = dict(vars(self))
+        state["db"] = None
+        return state
+
+    def setStats(self, stats):
+        """
+        Hand each variable its counts from the stats that `writeMetadata`
+        collects, so that building the tables doesn't have to scan for them.
+        """
+        self.stats = stats
+        for variable in self.variables:
+            variable.stats = None
+            if stats is not None:
+                variable.stats = stats["fields"].get(variable.field)
         
     def setTableNames(self):
         """
@@ -543,44 +670,18 @@ class variableSet(object):
 
             self.fastName = self.tableName + "heap"
 
-    def guessAtFieldDescriptions(self,stopAfter=30000):
-        allMyKeys = dict()
-        unique = True
-        
-        for i, line in enumerate(open(self.originFile)):
-            try:
-                entry = json.loads(line.rstrip("\n"))
-            except:
-                logging.warning("Error in line {} of {}".format(i, self.originFile))
-                logging.warning(line)
-                
-            for key in entry:
-                if type(entry[key])==list:
-                    unique=False
-                else:
-                    #Treat it for counting sake as a single element list.
-                    entry[key] = [entry[key]]
-                for value in entry[key]:
-                    try:
-                        allMyKeys[key][value] += 1
-                    except KeyError:
-                        try:
-                            allMyKeys[key][value] = 1
-                        except KeyError:
-                            allMyKeys[key] = dict()
-                            allMyKeys[key][value] = 1
-            if i > stopAfter:
-                break
-
-        myOutput = []
+    def guessAtFieldDescriptions(self,stopAfter=None):
+        """
+        Guess at a description of every field from a profile of its
+        values across the whole catalog, or only the first `stopAfter`
+        lines if given.
+        """
+        if stopAfter is None:
+            profiles = profile_file(self.originFile)
+        else:
+            profiles = profile_lines(islice(open(self.originFile), stopAfter))
 
-        for metadata in allMyKeys:
-            
-            bestGuess = guessBasedOnNameAndContents(metadata,allMyKeys[metadata])
-            if unique==False:
-                bestGuess['unique'] = False
-            
-            myOutput.append(bestGuess)
+        myOutput = [guess_description(profile) for profile in profiles.values()]
 
         myOutput = [output for output in myOutput if output["field"] != "filename"]
 
@@ -618,7 +719,7 @@ class variableSet(object):
                 It is faster, better, and (on the first run only) sometimes necessary
                 to pull the textids from the original files, not the database.
                 """
-                bookids = KV(".bookworm/metadata/textids.sqlite")
+                bookids = KV(".bookworm/metadata/textids.sqlite", readonly=True)
                 for variable in self.variables:
                     variable.anchor=self.fastAnchor
             except IOError:
@@ -659,14 +760,14 @@ class variableSet(object):
         """
         This is a general purpose, with a few special cases for the primary use case that this is the
         "catalog" table that hold the primary lookup information.
+
+        The input is split into chunks that are formatted by a pool of
+        processes (see `formatMetadataChunk`); the results are written out
+        in input order, so the files are the same as with one process.
         """
-        linenum = 1
         variables = self.variables
         bookids = self.anchorLookupDictionary()
 
-        metadatafile = open(self.originFile)
-
-
         #Open files for writing to
         path = os.path.dirname(self.catalogLocation)
         try:
@@ -675,12 +776,81 @@ class variableSet(object):
             if not os.path.isdir(path):
                 raise
 
+        #We always lead with the bookid and the filename.
+        if self.anchorField=="bookid" and self.tableName=="catalog":
+            self.anchorField="filename"
+
         catalog = open(self.catalogLocation, 'w')
 
         for variable in [variable for variable in variables if not variable.unique]:
             variable.output = open(variable.outputloc, 'w')
 
-        for entry in metadatafile:
+        cpus, _ = mp_stats()
+        pool = None
+        if limit < float("Inf") or cpus == 1:
+            with open(self.originFile) as metadatafile:
+                chunks = [self.formatMetadata(metadatafile, bookids, limit)]
+        else:
+            lookup = bookids
+            if isinstance(bookids, KV):
+                # Workers each open their own (frozen) copy of the table.
+                bookids.export()
+                lookup = bookids.dbfile
+            n = max(cpus * 4, os.path.getsize(self.originFile) // METADATA_CHUNK_BYTES)
+            pool = Pool(cpus, initializer=initMetadataWorker, initargs=(self, lookup))
+            chunks = pool.imap(formatMetadataChunk, shards(self.originFile, n, ordered=True))
+
+        rows = 0
+        values = dict([(variable.field, DistinctValues()) for variable in variables if variable.datatype == "categorical"])
+        for catalogtext, variabletext, chunkvalues in chunks:
+            catalog.write(catalogtext)
+            rows += catalogtext.count("\n")
+            for variable in [variable for variable in variables if not variable.unique]:
+                variable.output.write(variabletext[variable.field])
+            for field, chunk in chunkvalues.items():
+                values[field].update(chunk)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for variable in [variable for variable in variables if not variable.unique]:
+            variable.output.close()
+        catalog.close()
+        self.writeStats(rows, dict([(field, values[field].count()) for field in values]),
+                        dict([(field, values[field].maxlength) for field in values]))
+
+    def writeStats(self, rows, distinct, maxlengths):
+        """
+        Save the number of rows written to the catalog, and the number of
+        distinct values (see `DistinctValues.count`) and longest value of
+        each categorical field, for
+        `setIntType`, `buildIdTable`, and `fastLookupTableIfNecessary` to
+        read instead of querying MySQL.
+        """
+        stats = {"rows": rows, "fields": dict()}
+        for field in distinct:
+            stats["fields"][field] = {
+                "distinct": distinct[field],
+                "maxlength": maxlengths[field]
+            }
+        with open(stats_location(self.catalogLocation), "w") as fout:
+            json.dump(stats, fout)
+        self.setStats(stats)
+
+    def formatMetadata(self, lines, bookids, limit=float("Inf")):
+        """
+        Format lines of the json metadata file as text for the catalog and
+        for each non-unique variable's file. Returns the catalog text, a
+        dict from each non-unique field to its text, and a dict from each
+        categorical field to the `DistinctValues` written for it.
+        """
+        linenum = 1
+        variables = self.variables
+        catalog = []
+        outputs = dict([(variable.field, []) for variable in variables if not variable.unique])
+        values = dict([(variable.field, DistinctValues()) for variable in variables if variable.datatype == "categorical"])
+
+        for entry in lines:
             
             try:
                 entry = json.loads(entry)
@@ -690,13 +860,7 @@ class variableSet(object):
                 
                 continue
 
-            #We always lead with the bookid and the filename.
             #Unicode characters in filenames may cause problems?
-            if self.anchorField=="bookid" and self.tableName=="catalog":
-                self.anchorField="filename"
-
-            filename = to_unicode(entry[self.anchorField])
-
             try:
                 bookid = bookids[entry[self.anchorField]]
             except KeyError:
@@ -721,15 +885,14 @@ class variableSet(object):
                     if myfield is None:
                         myfield = ''
                     mainfields.append(to_unicode(myfield))
-            catalogtext = '%s\n' % '\t'.join(mainfields)
-            try:
-                catalog.write(catalogtext)
-            except TypeError:
-                catalog.write(catalogtext)
+                    if var.field in values:
+                        values[var.field].add(mainfields[-1])
+            catalog.append('%s\n' % '\t'.join(mainfields))
                 
             for variable in [variable for variable in variables if not variable.unique]:
                 # Each of these has a different file it must write to...
-                outfile = variable.output
+                outfile = outputs[variable.field]
+                seen = values.get(variable.field)
                 lines = entry.get(variable.field, [])
                 if isinstance(lines, (str, bytes, int)):
                     """
@@ -740,27 +903,63 @@ class variableSet(object):
                     lines = []
                 for line in lines:
                     try:
-                        writing = '%s\t%s\n' % (str(bookid), to_unicode(line))
-                        outfile.write(writing)
+                        outfile.append('%s\t%s\n' % (str(bookid), to_unicode(line)))
+                        if seen is not None:
+                            seen.add(str(to_unicode(line)))
                     except:
                         logging.warning("some sort of error with bookid no. " +str(bookid) + ": " + json.dumps(lines))
                         pass
             if linenum > limit:
                 break
             linenum=linenum+1
-        for variable in [variable for variable in variables if not variable.unique]:
-            variable.output.close()
-        catalog.close()
-        metadatafile.close()
+        return "".join(catalog), dict([(k, "".join(v)) for k, v in outputs.items()]), values
 
     def loadMetadata(self):
         """
         Load in the metadata files which have already been created elsewhere.
+
+        The main table, each non-unique variable's disk table, and each
+        categorical variable's ID and lookup tables are built as separate
+        steps, which run at once over a few connections wherever they
+        don't depend on each other. The largest disk tables start first.
         """
 
         #This function is called for the sideffect of assigning a `fastAnchor` field
         bookwormcodes = self.anchorLookupDictionary()
         db = self.db
+
+        steps = [("main", self.loadMainTable, [])]
+        def size(variable):
+            if os.path.exists(variable.outputloc):
+                return os.path.getsize(variable.outputloc)
+            return 0
+        disk = sorted(self.notUniques(), key=size, reverse=True)
+        for variable in disk:
+            steps.append((variable.field + "Disk", variable.buildDiskTable, []))
+        for variable in self.variables:
+            if variable.datatype=="categorical":
+                requires = []
+                if not variable.unique:
+                    requires.append(variable.field + "Disk")
+                if variable.unique or (self.tableName=="catalog" and self.stats is None):
+                    # Counts come from the main table.
+                    requires.append("main")
+                steps.append((variable.field + "__id", variable.build_ID_and_lookup_tables, requires))
+
+        run_on_connections(steps, db, min(LOAD_CONNECTIONS, len(steps)))
+
+        if len(self.uniques()) > 0 and self.tableName!="catalog":
+            #catalog has separate rules handled in CreateDatabase.py.
+            fileCommand = self.uniqueVariableFastSetup("MYISAM")
+            for query in splitMySQLcode(fileCommand):
+                db.query(query)
+
+    def loadMainTable(self, db=None):
+        """
+        Create the main (slow) table for the unique variables, and load it.
+        """
+        if db is None:
+            db = self.db
         logging.info("Making a SQL table to hold the catalog data")
 
         if self.tableName=="catalog":
@@ -812,20 +1011,7 @@ class variableSet(object):
 
             #This here stores the number of words in between catalog updates, so that the full word counts only have to be done once since they're time consuming.
             if self.tableName=="catalog":
-                self.createNwordsFile()
-
-        for variable in self.notUniques():
-            variable.buildDiskTable()
-
-        for variable in self.variables:
-            if variable.datatype=="categorical":
-                variable.build_ID_and_lookup_tables()
-                
-        if len(self.uniques()) > 0 and self.tableName!="catalog":
-            #catalog has separate rules handled in CreateDatabase.py.
-            fileCommand = self.uniqueVariableFastSetup("MYISAM")
-            for query in splitMySQLcode(fileCommand):
-                db.query(query)
+                self.createNwordsFile(db=db)
 
     def uniqueVariableFastSetup(self,engine="MEMORY"):
         fileCommand = "DROP TABLE IF EXISTS tmp;"
@@ -879,19 +1065,124 @@ class variableSet(object):
             self.db.query('DELETE FROM masterTableTable WHERE masterTableTable.tablename="%s";' %self.fastName)
             self.db.query("INSERT INTO masterTableTable VALUES (%s, %s, %s)", (self.fastName,parentTab,escape_string(fileCommand)))
     
-    def createNwordsFile(self):
+    def createNwordsFile(self, nwordsdir=".bookworm/texts/encoded/nwords", db=None):
         """
         A necessary supplement to the `catalog` table.
+
+        The encoders write each document's word count to `nwordsdir`; when
+        those files are there they're loaded (and added up by bookid)
+        instead of summing master_bookcounts.
         """
-        db = self.db
+        if db is None:
+            db = self.db
 
         db.query("CREATE TABLE IF NOT EXISTS nwords (bookid MEDIUMINT UNSIGNED, PRIMARY KEY (bookid), nwords INT);")
+        files = []
+        if os.path.exists(nwordsdir):
+            files = [f for f in os.listdir(nwordsdir) if f.endswith(".txt")]
+        if len(files) > 0:
+            logging.info("loading word counts from %d files in %s" % (len(files), nwordsdir))
+            # A document split across several inputs has a count in each
+            # file, so they're staged and then added up.
+            db.query("DROP TABLE IF EXISTS nwords__tmp")
+            db.query("CREATE TABLE nwords__tmp (bookid MEDIUMINT UNSIGNED, nwords INT)")
+            from .CreateDatabase import load_counts
+            for filename in files:
+                load_counts(db, "%s/%s" % (nwordsdir, filename), "nwords__tmp", ["bookid", "nwords"])
+            db.query("REPLACE INTO nwords (bookid,nwords) SELECT bookid,SUM(nwords) FROM nwords__tmp GROUP BY bookid")
+            db.query("DROP TABLE nwords__tmp")
+        else:
+            # Encoded before the word counts were written out: sum them up here.
+            db.query("INSERT INTO nwords (bookid,nwords) SELECT catalog.bookid,sum(count) FROM catalog LEFT JOIN nwords USING (bookid) JOIN master_bookcounts USING (bookid) WHERE nwords.bookid IS NULL GROUP BY catalog.bookid")
         db.query("UPDATE catalog JOIN nwords USING (bookid) SET catalog.nwords = nwords.nwords")
-        db.query("INSERT INTO nwords (bookid,nwords) SELECT catalog.bookid,sum(count) FROM catalog LEFT JOIN nwords USING (bookid) JOIN master_bookcounts USING (bookid) WHERE nwords.bookid IS NULL GROUP BY catalog.bookid")
-        db.query("UPDATE catalog JOIN nwords USING (bookid) SET catalog.nwords = nwords.nwords")
 
 
 
+def connections(db, n):
+    """
+    `db` and n - 1 more connections to the same database.
+    """
+    from .CreateDatabase import DB
+    return [db] + [DB(dbname=db.dbname) for i in range(n - 1)]
+
+def run_steps(steps, dbs):
+    """
+    Run a list of (name, function, [names of steps it requires]) in
+    threads, each step as soon as the steps it requires have finished,
+    and as many at once as there are connections in `dbs`. Every
+    function is called with the connection it should use.
+    """
+    free = queue.Queue()
+    for db in dbs:
+        free.put(db)
+
+    def run(function):
+        db = free.get()
+        try:
+            function(db=db)
+        finally:
+            free.put(db)
+
+    names = set([name for name, _, _ in steps])
+    for name, _, requires in steps:
+        for required in requires:
+            if required not in names:
+                raise ValueError("{} requires {}, which isn't a step".format(name, required))
+
+    done = set()
+    running = dict()
+    waiting = list(steps)
+    with ThreadPoolExecutor(len(dbs)) as executor:
+        while len(waiting) > 0 or len(running) > 0:
+            for step in list(waiting):
+                name, function, requires = step
+                if all([required in done for required in requires]):
+                    logging.debug("Starting " + name)
+                    running[executor.submit(run, function)] = name
+                    waiting.remove(step)
+            if len(running) == 0:
+                raise ValueError("Steps {} require each other".format([name for name, _, _ in waiting]))
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                # Raises any error from the step.
+                future.result()
+                done.add(running.pop(future))
+
+def run_on_connections(steps, db, n):
+    """
+    `run_steps` over `db` and n - 1 more connections, which are closed after.
+    """
+    dbs = connections(db, n)
+    try:
+        run_steps(steps, dbs)
+    finally:
+        for extra in dbs[1:]:
+            if extra.conn is not None:
+                extra.conn.close()
+
+# The variableSet and bookid lookup that `formatMetadataChunk` works
+# from in each worker: see `initMetadataWorker`.
+metadata_writer = None
+
+def initMetadataWorker(variableset, bookids):
+    """
+    Set up a worker process for `formatMetadataChunk`. `variableset` comes
+    without its database connection, and `bookids` is either a dict or the
+    path to a KV table, which is opened read-only here; so this works
+    however the pool starts its processes.
+    """
+    global metadata_writer
+    if isinstance(bookids, str):
+        bookids = KV(bookids, readonly=True).frozen()
+    metadata_writer = (variableset, bookids)
+
+def formatMetadataChunk(shard):
+    """
+    Format one (path, start, end) shard of the metadata file in a worker process.
+    """
+    variableset, bookids = metadata_writer
+    return variableset.formatMetadata(read_shard(*shard), bookids)
+
 class DummyDict(dict):
     """
     Stupid little hack.
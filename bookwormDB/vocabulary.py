@@ -0,0 +1,173 @@
+import os
+import mmap
+import struct
+import zlib
+import logging
+import numpy as np
+
+"""
+A compact, read-only, on-disk version of `wordlist.txt`.
+
+`readDictionaryFile` builds a Python dict of the whole wordlist, which
+for 1.5 million words costs several hundred megabytes and a few seconds
+in every encode process. The vocabulary file here is built once and then
+memory-mapped read-only by each worker, so all of them share a single
+copy through the page cache and start up instantly.
+
+The file is laid out as:
+
+    header      magic, number of words, number of hash slots
+    offsets     (n + 1) uint64 offsets of each word in the blob
+    ids         n int64 wordids, in the same order
+    slots       open-addressed hash table: 1 + the index of a word, or 0
+    blob        the utf-8 encoded words, sorted, end to end
+
+Words are found by crc32 hash with linear probing.
+"""
+
+MAGIC = b"BWVOCAB1"
+HEADER = struct.Struct("<8sQQ")
+
+
+def vocabulary_location(wordlist):
+    return os.path.splitext(wordlist)[0] + ".vocab"
+
+
+def build_vocabulary(wordlist=".bookworm/texts/wordlist/wordlist.txt", output=None):
+    """
+    Write the vocabulary file for a wordlist, unless an up-to-date one
+    already exists. Returns the path to it.
+    """
+    if output is None:
+        output = vocabulary_location(wordlist)
+    if os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(wordlist):
+        return output
+
+    logging.info("Building shared vocabulary file at {}".format(output))
+    entries = []
+    for line in open(wordlist):
+        line = line.rstrip("\n")
+        v, k, _ = line.split("\t")
+        entries.append((k.encode("utf-8"), int(v)))
+    entries.sort()
+
+    n = len(entries)
+    nslots = 1
+    while nslots < 2 * n:
+        nslots *= 2
+    offsets = np.zeros(n + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(word) for word, _ in entries])
+    ids = np.array([wordid for _, wordid in entries], dtype="<i8")
+    slots = [0] * nslots
+    mask = nslots - 1
+    for i, (word, _) in enumerate(entries):
+        slot = zlib.crc32(word) & mask
+        while slots[slot] != 0:
+            slot = (slot + 1) & mask
+        slots[slot] = i + 1
+    slots = np.array(slots, dtype="<i8")
+
+    # Write to a temporary name so that no process ever maps half a file.
+    tmp = "{}.{}.tmp".format(output, os.getpid())
+    with open(tmp, "wb") as fout:
+        fout.write(HEADER.pack(MAGIC, n, nslots))
+        fout.write(offsets.tobytes())
+        fout.write(ids.tobytes())
+        fout.write(slots.tobytes())
+        for word, _ in entries:
+            fout.write(word)
+    os.replace(tmp, output)
+    return output
+
+
+class Vocabulary(object):
+    """
+    A read-only mapping from words to wordids, backed by a memory-mapped
+    vocabulary file.
+
+    Like the dict from `readDictionaryFile`, indexing returns the wordid
+    as a string; `ids` looks up many words at once and returns integers.
+    A small cache in front of the hash table keeps the most common words
+    fast without growing toward the size of the full vocabulary.
+    """
+
+    def __init__(self, path, cache_size=100000):
+        self.path = path
+        with open(path, "rb") as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, self.nslots = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a bookworm vocabulary file".format(path))
+        self.mask = self.nslots - 1
+        self.view = view = memoryview(self.mm)
+        start = HEADER.size
+        self.offsets = view[start:start + 8 * (self.n + 1)].cast("Q")
+        start += 8 * (self.n + 1)
+        self.wordids = view[start:start + 8 * self.n].cast("q")
+        start += 8 * self.n
+        self.slots = view[start:start + 8 * self.nslots].cast("q")
+        self.blob = start + 8 * self.nslots
+        self.cache_size = cache_size
+        self.cache = dict()
+
+    def __len__(self):
+        return self.n
+
+    def word(self, i):
+        return self.mm[self.blob + self.offsets[i]:self.blob + self.offsets[i + 1]].decode("utf-8")
+
+    def find(self, key):
+        """
+        Return the integer wordid for a word, or -1 if it isn't there.
+        """
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        word = key.encode("utf-8")
+        mm, offsets, slots, blob, mask = self.mm, self.offsets, self.slots, self.blob, self.mask
+        slot = zlib.crc32(word) & mask
+        wordid = -1
+        while True:
+            i = slots[slot] - 1
+            if i < 0:
+                break
+            if mm[blob + offsets[i]:blob + offsets[i + 1]] == word:
+                wordid = self.wordids[i]
+                break
+            slot = (slot + 1) & mask
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = wordid
+        return wordid
+
+    def __getitem__(self, key):
+        wordid = self.find(key)
+        if wordid < 0:
+            raise KeyError(key)
+        return str(wordid)
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def get(self, key, default=None):
+        wordid = self.find(key)
+        if wordid < 0:
+            return default
+        return str(wordid)
+
+    def ids(self, words):
+        """
+        Look up a list of words; returns an int64 array, with -1 for
+        words that aren't in the vocabulary.
+        """
+        return np.fromiter(map(self.find, words), dtype=np.int64, count=len(words))
+
+    def items(self):
+        for i in range(self.n):
+            yield self.word(i), str(self.wordids[i])
+
+    def close(self):
+        for view in [self.offsets, self.wordids, self.slots, self.view]:
+            view.release()
+        self.mm.close()
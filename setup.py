@@ -35,7 +35,7 @@ setup(
         "Topic :: Text Processing :: Linguistic"
     ],
     install_requires=["numpy","pandas","mysqlclient",
-                      "python-dateutil", "psutil", "bounter",
+                      "python-dateutil", "psutil", "bounter", "regex",
                       "gunicorn"
     ]
 )
@@ -0,0 +1,59 @@
+"""
+Compare parsing pre-tokenized feature counts one document at a time
+with pandas (the old `PreTokenized` path) against the block parser.
+
+Run from the tests directory with `python benchmark_pretokenized.py`.
+The feature counts are generated from the unigrams of
+test_bookworm_files/input.txt; both parsers must agree exactly.
+"""
+
+import os
+import time
+from io import StringIO
+import numpy as np
+from pandas import read_csv
+from bookwormDB.tokenizer import Tokenizer, PreTokenized
+
+def feature_rows(copies=5):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "test_bookworm_files", "input.txt")
+    rows = []
+    for line in open(path):
+        filename, text = line.rstrip("\n").split("\t", 1)
+        counts = Tokenizer(text).counts("words")
+        pairs = []
+        for word, count in counts.items():
+            if "," in word or '"' in word:
+                word = '"' + word.replace('"', '""') + '"'
+            pairs.append("{},{}".format(word, count))
+        rows.append("\f".join(pairs))
+    return rows * copies
+
+def read_csv_counts(csv_string, level):
+    f = read_csv(StringIO(csv_string),
+                 lineterminator = "\f",
+                 dtype = {'word': str, 'counts': np.int64},
+                 keep_default_na=False,
+                 names = ["word", "counts"])
+    if level == 'words':
+        return dict(zip(f.word, f.counts))
+    return dict(zip([tuple(w.split(" ")) for w in f.word], f.counts))
+
+def main(blocksize=2000):
+    rows = feature_rows()
+    print("{} documents, {} word/count pairs".format(len(rows), sum(r.count("\f") + 1 for r in rows)))
+
+    t0 = time.time()
+    old = [read_csv_counts(row, "words") for row in rows]
+    t1 = time.time()
+    new = []
+    for i in range(0, len(rows), blocksize):
+        new.extend([p.counts("words") for p in PreTokenized.batch(rows[i:i + blocksize], "words")])
+    t2 = time.time()
+
+    assert old == new, "Parsers disagree"
+    print("read_csv per document: {:.3f}s ({:.0f} docs/s)".format(t1 - t0, len(rows) / (t1 - t0)))
+    print("block parser:          {:.3f}s ({:.0f} docs/s)".format(t2 - t1, len(rows) / (t2 - t1)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare the python and numpy n-gram counting engines on the test corpus.
+
+Run from the tests directory with `python benchmark_tokenizer.py`.
+Each engine counts and encodes every document in
+test_bookworm_files/input.txt; the outputs must match exactly.
+It also times a second pass in which the whole corpus is treated as a
+single document, which is closer to a newspaper issue or a full book.
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+from bookwormDB.tokenizer import Tokenizer, tokenBatches
+
+def load_documents():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "test_bookworm_files", "input.txt")
+    docs = []
+    for line in open(path):
+        filename, text = line.rstrip("\n").split("\t", 1)
+        docs.append(text)
+    return docs
+
+def build_dictionary(tokenizers, size=5000):
+    counts = Counter()
+    for t in tokenizers:
+        counts.update(t.tokenize())
+    return {word: str(i) for i, (word, _) in enumerate(counts.most_common(size))}
+
+def run(tokenizers, dictionary, level, engine):
+    batch = tokenBatches([level], engine=engine)
+    batch.dictionary = dictionary
+    t0 = time.time()
+    counts = [t.counts(level, engine=engine) for t in tokenizers]
+    t1 = time.time()
+    if level == "words":
+        # Words are only counted, never encoded.
+        encoded = None
+    elif engine == "numpy":
+        encoded = [batch.encodeIdCounts(i, t, level) for i, t in enumerate(tokenizers)]
+    else:
+        encoded = [batch.encodeCounts(i, t.counts(level)) for i, t in enumerate(tokenizers)]
+    t2 = time.time()
+    return counts, encoded, t1 - t0, t2 - t1
+
+def main(repeats=3):
+    docs = load_documents()
+    corpora = [
+        ("paragraphs", docs),
+        ("single document", [" ".join(docs)] * 5)
+    ]
+    print("{:<16} {:<9} {:<7} {:>10} {:>10}".format("corpus", "level", "engine", "counts (s)", "encode (s)"))
+    for name, texts in corpora:
+        tokenizers = [Tokenizer(text) for text in texts]
+        dictionary = build_dictionary(tokenizers)
+        for level in ["words", "unigrams", "bigrams"]:
+            results = dict()
+            for engine in ["python", "numpy"]:
+                timings = []
+                for _ in range(repeats):
+                    counts, encoded, count_time, encode_time = run(tokenizers, dictionary, level, engine)
+                    timings.append((count_time, encode_time))
+                results[engine] = (counts, encoded)
+                count_time, encode_time = min(timings)
+                print("{:<16} {:<9} {:<7} {:>10.3f} {:>10.3f}".format(name, level, engine, count_time, encode_time))
+            assert results["python"][1] == results["numpy"][1], "Encoded output differs"
+            for a, b in zip(results["python"][0], results["numpy"][0]):
+                assert list(a.items()) == list(b.items()), "Counts differ"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.MetaParser import parse_date, date_deriver, defaultDate, derive_date_columns, json_cells
+import json
+import dateutil.parser
+import unittest
+
+"""
+Tests of catalog date parsing that don't need a database.
+"""
+
+class Bookworm_Dates(unittest.TestCase):
+
+    def test_fast_path_matches_dateutil(self):
+        for string in ["1787-10-27", "1850", "1850-03", "0001-01-01",
+                       "1999-1-2", "99", "March 5, 1850", "1850-03-05T10:30:00"]:
+            self.assertEqual(parse_date(string),
+                             dateutil.parser.parse(string, default = defaultDate))
+
+    def test_fast_path_rejects_what_dateutil_rejects(self):
+        for string in ["0000", "2001-02-30", "1987-02-29", "garbage"]:
+            self.assertRaises(ValueError, parse_date, string)
+
+    def test_derived_fields(self):
+        field = {"field": "date", "derived": [
+            {"resolution": "year"}, {"resolution": "day"},
+            {"resolution": "day", "aggregate": "week"},
+            {"resolution": "minute", "aggregate": "day"}]}
+        derive = date_deriver(field)
+        self.assertEqual(derive("1850-03-05T10:30:00"),
+                         {"date_year": 1850, "date_day": 675762,
+                          "date_day_week": 2, "date_minute_day": 630})
+        self.assertIsNone(derive("garbage"))
+        # The second call comes from the cache.
+        derive("garbage")
+        self.assertEqual(derive.cache_info().hits, 1)
+
+    def test_columnar_derivation_matches(self):
+        field = {"field": "date", "derived": [
+            {"resolution": "year"}, {"resolution": "month"}, {"resolution": "week"},
+            {"resolution": "day"}, {"resolution": "day", "aggregate": "year"},
+            {"resolution": "day", "aggregate": "week"},
+            {"resolution": "month", "aggregate": "year"},
+            {"resolution": "week", "aggregate": "year"},
+            {"resolution": "hour", "aggregate": "day"}]}
+        values = ["1787-10-27", "1850", "2000-02", "March 5, 1850 10:30",
+                  "2001-02-30", "", "garbage", "1787-10-27", "0001-01-01"]
+        parsed, columns = derive_date_columns(field, values)
+        derive = date_deriver(field)
+        for i, value in enumerate(values):
+            expected = derive(value)
+            self.assertEqual(parsed[i], expected is not None)
+            if expected is not None:
+                self.assertEqual(dict([(k, v[i]) for k, v in columns.items()]), expected)
+
+    def test_json_cells(self):
+        values = ["plain", 'quote " and \x00 nul', "Ünïcödé", 3]
+        self.assertEqual(json_cells(values), [json.dumps(v) for v in values])
+
+if __name__=="__main__":
+    unittest.main()
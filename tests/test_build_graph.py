@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.build_graph import BuildGraph, Stage
+from functools import partial
+import multiprocessing
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+"""
+Tests of the build graph that don't need a database.
+"""
+
+def append(source, destination):
+    with open(source) as fin, open(destination, "a") as fout:
+        fout.write(fin.read())
+
+def copy(source, destination):
+    return partial(append, source, destination)
+
+def lines(path):
+    """
+    A stand-in for a table's row count.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return len(fin.readlines())
+
+def fail():
+    sys.exit(1)
+
+class Bookworm_Build_Graph(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        with open("a.txt", "w") as fout:
+            fout.write("a")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def stages(self):
+        return [Stage("b", copy("a.txt", "b.txt"), inputs=["a.txt"], outputs=["b.txt"], clean=["b.txt"]),
+                Stage("c", copy("b.txt", "c.txt"), requires=["b"], inputs=["b.txt"], outputs=["c.txt"], clean=["c.txt"])]
+
+    def statuses(self, graph):
+        return dict([(name, status) for name, status, _ in graph.report])
+
+    def test_skips_unchanged_stages(self):
+        graph = BuildGraph(self.stages(), directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"b": "ran", "c": "ran"})
+        self.assertEqual(open("c.txt").read(), "a")
+        graph = BuildGraph(self.stages(), directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"b": "skipped", "c": "skipped"})
+        self.assertTrue(os.path.exists("build/timing.txt"))
+
+    def test_reruns_changed_stages(self):
+        BuildGraph(self.stages(), directory="build").run()
+        # The same content under a new mtime is still unchanged.
+        with open("a.txt", "w") as fout:
+            fout.write("a")
+        graph = BuildGraph(self.stages(), directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"b": "skipped", "c": "skipped"})
+        with open("a.txt", "w") as fout:
+            fout.write("A")
+        graph = BuildGraph(self.stages(), directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"b": "ran", "c": "ran"})
+        self.assertEqual(open("c.txt").read(), "A")
+
+    def test_spawned_stages(self):
+        graph = BuildGraph(self.stages(), directory="build", context=multiprocessing.get_context("spawn"))
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"b": "ran", "c": "ran"})
+        self.assertEqual(open("c.txt").read(), "a")
+
+    def test_checks(self):
+        # "table.txt" isn't declared as an output, like a database table.
+        stages = [Stage("table", copy("a.txt", "table.txt"), inputs=["a.txt"],
+                        checks=[partial(lines, "table.txt")])]
+        BuildGraph(stages, directory="build").run()
+        graph = BuildGraph(stages, directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"table": "skipped"})
+        # Rows missing from the table.
+        with open("table.txt", "w") as fout:
+            fout.write("")
+        graph = BuildGraph(stages, directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"table": "ran"})
+        # The table dropped.
+        os.remove("table.txt")
+        graph = BuildGraph(stages, directory="build")
+        graph.run()
+        self.assertEqual(self.statuses(graph), {"table": "ran"})
+        self.assertEqual(open("table.txt").read(), "a")
+
+    def test_failure(self):
+        stages = [Stage("b", fail, outputs=["b.txt"]),
+                  Stage("c", copy("a.txt", "c.txt"), requires=["b"])]
+        graph = BuildGraph(stages, directory="build")
+        self.assertRaises(RuntimeError, graph.run)
+        self.assertEqual(self.statuses(graph), {"b": "failed"})
+        self.assertFalse(os.path.exists("c.txt"))
+
+if __name__=="__main__":
+    unittest.main()
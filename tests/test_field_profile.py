@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.field_profile import HyperLogLog, value_hashes, profile_lines, guess_description
+import json
+import random
+import unittest
+
+"""
+Tests of catalog field profiling that don't need a database.
+"""
+
+class Bookworm_Field_Profile(unittest.TestCase):
+
+    def test_distinct_estimates(self):
+        for n in [5, 1000, 50000]:
+            hll = HyperLogLog()
+            hll.add_hashes(value_hashes(range(n)))
+            self.assertLess(abs(hll.estimate() - n), n * .05 + 1)
+
+    def test_chunks_merge(self):
+        rng = random.Random(1)
+        lines = [json.dumps({"filename": str(i), "genre": rng.choice(["a", "b", "c"]) if i % 10 else str(i),
+                             "year": 1800 + i % 50, "subject": ["x", "y"]}) for i in range(20000)]
+        whole = profile_lines(lines)
+        merged = profile_lines(lines[:5000], 1)
+        for seed, start in enumerate(range(5000, 20000, 5000)):
+            for key, profile in profile_lines(lines[start:start + 5000], seed + 2).items():
+                merged[key].merge(profile, rng)
+        for key in whole:
+            self.assertEqual(whole[key].count, merged[key].count)
+            self.assertEqual(whole[key].distinct.estimate(), merged[key].distinct.estimate())
+            self.assertEqual(len(merged[key].sample), 1000)
+        self.assertEqual(set(dict(merged["genre"].top.most_common(3))), set(["a", "b", "c"]))
+
+    def test_guess(self):
+        lines = [json.dumps({"filename": str(i), "year": 1800 + i % 50, "title": str(i),
+                             "subject": ["x", "y"], "searchstring": "z"}) for i in range(1000)]
+        guesses = dict([(profile.name, guess_description(profile))
+                        for profile in profile_lines(lines).values()])
+        self.assertEqual(guesses["year"], {"field": "year", "datatype": "categorical",
+                                           "type": "integer", "unique": True})
+        self.assertEqual(guesses["subject"]["unique"], False)
+        self.assertEqual(guesses["title"]["unique"], True)
+        self.assertEqual(guesses["searchstring"]["datatype"], "searchstring")
+
+if __name__=="__main__":
+    unittest.main()
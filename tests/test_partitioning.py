@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.CreateDatabase import partition_sql, partitions_supported, check_partitioning
+from unittest import mock
+import unittest
+
+"""
+Tests of the DDL for natively partitioned count tables, which don't need
+a database.
+"""
+
+class Server(object):
+    """
+    Answers the version query in `check_partitioning`.
+    """
+    def __init__(self, version, engine):
+        self.row = (version, engine)
+
+    def query(self, sql):
+        return mock.Mock(fetchall=lambda: [self.row])
+
+class Bookworm_Partitioning(unittest.TestCase):
+
+    def test_no_partitions(self):
+        self.assertEqual(partition_sql(None, 16), "")
+
+    def test_hash_partitions(self):
+        self.assertEqual(partition_sql("hash", 16), " PARTITION BY HASH(wordid) PARTITIONS 16")
+        self.assertEqual(partition_sql("hash", 4, "word1"), " PARTITION BY HASH(word1) PARTITIONS 4")
+
+    def test_range_partitions(self):
+        with mock.patch("bookwormDB.CreateDatabase.max_bookid", return_value=999):
+            self.assertEqual(partition_sql("range", 4),
+                             " PARTITION BY RANGE(bookid) (PARTITION p0 VALUES LESS THAN (250), "
+                             "PARTITION p1 VALUES LESS THAN (500), PARTITION p2 VALUES LESS THAN (750), "
+                             "PARTITION p3 VALUES LESS THAN MAXVALUE)")
+
+    def test_unknown_partitioning(self):
+        self.assertRaises(ValueError, partition_sql, "list", 4)
+
+    def test_supported_servers(self):
+        self.assertTrue(partitions_supported("10.6.12-MariaDB-0ubuntu0.22.04.1", "MyISAM"))
+        self.assertTrue(partitions_supported("5.7.42-log", "MyISAM"))
+        self.assertTrue(partitions_supported("8.0.34", "InnoDB"))
+        self.assertFalse(partitions_supported("8.0.34", "MyISAM"))
+        self.assertFalse(partitions_supported("8.4.0-0ubuntu1", "MYISAM"))
+
+    def test_check_partitioning(self):
+        check_partitioning(Server("5.7.42", "MyISAM"))
+        self.assertRaises(ValueError, check_partitioning, Server("8.0.34", "MyISAM"))
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.sharded_input import plain_ranges, gzip_member_index, gzip_ranges, \
+    read_shard, write_gzip_shards, input_files, shards, index_location
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+"""
+Tests of splitting input files into shards that don't need a database.
+"""
+
+def sample_lines(n):
+    return ["doc{}\tline number {} with ünïcödé {}\n".format(i, i, "x" * (i % 17)) for i in range(n)]
+
+def read_all(input_shards):
+    lines = []
+    for shard in input_shards:
+        lines.extend(read_shard(*shard))
+    return lines
+
+class Bookworm_Sharded_Input(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as fout:
+            fout.write(text)
+        return path
+
+    def test_plain_ranges_split_on_lines(self):
+        path = self.write("input.txt", "".join(sample_lines(1000)))
+        with open(path, "rb") as fin:
+            data = fin.read()
+        ranges = plain_ranges(path, 7)
+        self.assertEqual(len(ranges), 7)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertEqual(data[next_start - 1:next_start], b"\n")
+
+    def test_shards_give_back_the_input(self):
+        lines = sample_lines(1000)
+        path = self.write("input.txt", "".join(lines))
+        for n in [1, 2, 3, 16, 5000]:
+            self.assertEqual(read_all(shards(path, n)), lines)
+
+    def test_last_line_without_newline(self):
+        text = "".join(sample_lines(100)) + "doc100\tno newline at the end"
+        path = self.write("input.txt", text)
+        self.assertEqual("".join(read_all(shards(path, 4))), text)
+
+    def test_multi_member_gzip(self):
+        lines = sample_lines(1000)
+        path = self.write("input.txt", "".join(lines))
+        gz = os.path.join(self.dir, "input.txt.gz")
+        write_gzip_shards(path, gz, lines_per_member=10)
+        offsets = gzip_member_index(gz)
+        self.assertEqual(len(offsets), 100)
+        self.assertTrue(os.path.exists(index_location(gz)))
+        # The second time comes from the index.
+        self.assertEqual(gzip_member_index(gz), offsets)
+        self.assertEqual(len(gzip_ranges(gz, 4)), 4)
+        for n in [1, 4, 1000]:
+            self.assertEqual(read_all(shards(gz, n)), lines)
+
+    def test_gzip_members_off_line_boundaries(self):
+        # The second member starts partway through a line, so can't begin a shard.
+        gz = os.path.join(self.dir, "input.txt.gz")
+        with open(gz, "wb") as fout:
+            for part in ["a\tone\nb\ttw", "o\nc\tthree\n", "d\tfour\n"]:
+                fout.write(gzip.compress(part.encode("utf-8")))
+        self.assertEqual(len(gzip_member_index(gz)), 2)
+        self.assertEqual(read_all(shards(gz, 3)), ["a\tone\n", "b\ttwo\n", "c\tthree\n", "d\tfour\n"])
+
+    def test_single_member_gzip(self):
+        lines = sample_lines(500)
+        gz = os.path.join(self.dir, "input.txt.gz")
+        with open(gz, "wb") as fout:
+            fout.write(gzip.compress("".join(lines).encode("utf-8")))
+        self.assertEqual(gzip_ranges(gz, 4), [(0, None)])
+        self.assertEqual(shards(gz, 4, ordered=True), [(gz, 0, None)])
+        self.assertEqual(read_all(shards(gz, 4, ordered=True)), lines)
+        # Otherwise it's striped, a line at a time, over as many cores as there are.
+        with mock.patch("os.cpu_count", return_value=3):
+            striped = shards(gz, 4)
+        self.assertEqual(striped, [(gz, 0, None, i, 3) for i in range(3)])
+        self.assertEqual(list(read_shard(*striped[1])), lines[1::3])
+        self.assertEqual(sorted(read_all(striped)), sorted(lines))
+        with mock.patch("os.cpu_count", return_value=1):
+            self.assertEqual(shards(gz, 4), [(gz, 0, None)])
+
+    def test_empty_files(self):
+        path = self.write("empty.txt", "")
+        self.assertEqual(read_all(shards(path, 4)), [])
+        gz = os.path.join(self.dir, "empty.txt.gz")
+        with open(gz, "wb") as fout:
+            fout.write(gzip.compress(b""))
+        self.assertEqual(read_all(shards(gz, 4)), [])
+        self.assertEqual(shards([], 4), [])
+
+    def test_several_input_files(self):
+        lines = sample_lines(900)
+        os.makedirs(os.path.join(self.dir, "inputs"))
+        self.write("inputs/a.txt", "".join(lines[:300]))
+        self.write("inputs/b.txt", "")
+        write_gzip_shards(self.write("plain.txt", "".join(lines[300:])),
+                          os.path.join(self.dir, "inputs", "c.txt.gz"), lines_per_member=50)
+        # Neither of these is input.
+        self.write("inputs/.hidden", "nope\n")
+        gzip_member_index(os.path.join(self.dir, "inputs", "c.txt.gz"))
+
+        paths = input_files(os.path.join(self.dir, "inputs"))
+        self.assertEqual([os.path.basename(p) for p in paths], ["a.txt", "b.txt", "c.txt.gz"])
+        self.assertEqual(input_files(os.path.join(self.dir, "inputs", "*.gz")), paths[2:])
+        self.assertEqual(input_files([paths[1], paths[0]]), [paths[1], paths[0]])
+        self.assertRaises(FileNotFoundError, input_files, os.path.join(self.dir, "missing*"))
+        for n in [1, 3, 8]:
+            self.assertEqual(read_all(shards(paths, n)), lines)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.sqliteKV import KV, key_hash
+import unittest
+import sqlite3
+import tempfile
+import os
+
+"""
+Tests of the sqlite filename -> bookid store.
+"""
+
+class Bookworm_SQLite_KV(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.kv = KV(os.path.join(self.dir.name, "textids.sqlite"))
+        for i in range(1000):
+            self.kv.register("file-{}".format(i))
+        self.kv.conn.commit()
+
+    def tearDown(self):
+        self.kv.close()
+        self.dir.cleanup()
+
+    def test_get_many(self):
+        keys = ["file-1", "file-999", "missing"]
+        self.assertEqual(self.kv.get_many(keys), {"file-1": 2, "file-999": 1000})
+
+    def test_register_many_in_order(self):
+        ids, duplicates = self.kv.register_many(["new-1", "file-3", "new-2", "new-1"], batchsize=3)
+        self.assertEqual(ids.tolist(), [1001, 4, 1002, 1001])
+        self.assertEqual(duplicates, ["file-3", "new-1"])
+        self.assertEqual(self.kv.get_many(["new-1", "new-2"]), {"new-1": 1001, "new-2": 1002})
+
+    def test_register_many_into_empty_table(self):
+        kv = KV(os.path.join(self.dir.name, "empty.sqlite"))
+        ids, duplicates = kv.register_many(["a", "b", "a", "c", "b", "a"], batchsize=2)
+        self.assertEqual(ids.tolist(), [1, 2, 1, 3, 2, 1])
+        self.assertEqual(duplicates, ["a", "b", "a"])
+        self.assertEqual(kv.get_many(["a", "b", "c"]), {"a": 1, "b": 2, "c": 3})
+        # The unique index is back.
+        with self.assertRaises(sqlite3.IntegrityError):
+            kv.register("a")
+        kv.close()
+
+    def test_readonly_with_cache(self):
+        reader = KV(self.kv.dbfile, readonly=True, cache_size=10)
+        self.assertEqual(reader["file-9"], 10)
+        self.assertEqual(reader["file-9"], 10)
+        self.assertEqual(reader.cache_info().hits, 1)
+        with self.assertRaises(KeyError):
+            reader["missing"]
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.register("new")
+        reader.close()
+        with self.assertRaises(FileNotFoundError):
+            KV(os.path.join(self.dir.name, "missing.sqlite"), readonly=True)
+
+    def test_frozen_matches_database(self):
+        frozen = self.kv.frozen()
+        keys = ["file-{}".format(i) for i in range(0, 1000, 3)] + ["missing"]
+        self.assertEqual(frozen.get_many(keys), self.kv.get_many(keys))
+        for key in keys[:-1]:
+            self.assertEqual(frozen[key], self.kv[key])
+        with self.assertRaises(KeyError):
+            frozen["missing"]
+
+    def test_frozen_hash_collisions_use_database(self):
+        frozen = self.kv.frozen()
+        frozen.collisions.add(key_hash("file-5"))
+        self.assertEqual(frozen["file-5"], 6)
+        self.assertEqual(frozen.get_many(["file-5"]), {"file-5": 6})
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from bookwormDB.tokenizer import Tokenizer, tokenBatches, PreTokenized
+from bookwormDB.vocabulary import Vocabulary, build_vocabulary
+from bookwormDB.token_cache import TokenCacheWriter, cache_segments, read_segment
+import unittest
+import tempfile
+import os
+
+"""
+Tests of tokenization and n-gram counting that don't need a database.
+"""
+
+sample = "It was the best of times, it was the worst of times; it was the age of wisdom, " \
+         "it was the age of foolishness. Mr. Dickens' novel cost $3.50 in 1859."
+
+class Bookworm_Tokenizer(unittest.TestCase):
+
+    def test_engines_count_identically(self):
+        for level in ["words", "unigrams", "bigrams", "trigrams"]:
+            python = Tokenizer(sample).counts(level, engine="python")
+            numpy = Tokenizer(sample).counts(level, engine="numpy")
+            # Same counts, in the same order.
+            self.assertEqual(list(python.items()), list(numpy.items()))
+
+    def test_engines_encode_identically(self):
+        tokenizer = Tokenizer(sample)
+        dictionary = dict()
+        # Leave some words out of the dictionary so that n-grams get dropped.
+        for word in tokenizer.tokenize():
+            if word not in dictionary and word != "worst":
+                dictionary[word] = str(len(dictionary))
+        batch = tokenBatches(["bigrams"], engine="numpy")
+        batch.dictionary = dictionary
+        python = batch.encodeCounts(7, tokenizer.counts("bigrams"))
+        numpy = batch.encodeIdCounts(7, tokenizer, "bigrams")
+        self.assertEqual(python, numpy)
+        self.assertTrue(len(python) > 0)
+
+    def test_short_documents(self):
+        for text in ["", "word"]:
+            self.assertEqual(Tokenizer(text).counts("bigrams", engine="numpy"), dict())
+
+    def test_pretokenized_parsing(self):
+        texts = ['the,3\fNA,2\f1,5\f"a,b",7\f\f', 'new york,4\fof the,1', '']
+        parsed = [p.counts("words") for p in PreTokenized.batch(texts, "words")]
+        self.assertEqual(parsed, [{"the": 3, "NA": 2, "1": 5, "a,b": 7},
+                                  {"new york": 4, "of the": 1},
+                                  {}])
+        self.assertEqual(PreTokenized(texts[1], "bigrams").counts("bigrams"),
+                         {("new", "york"): 4, ("of", "the"): 1})
+
+    def test_vocabulary_matches_wordlist(self):
+        words = ["the", "of", "Ünïcödé", "NA", "times", "it's", "$3.50"]
+        with tempfile.TemporaryDirectory() as dir:
+            wordlist = os.path.join(dir, "wordlist.txt")
+            with open(wordlist, "w") as fout:
+                for i, word in enumerate(words):
+                    fout.write("{}\t{}\t{}\n".format(i, word, 100 - i))
+            vocabulary = Vocabulary(build_vocabulary(wordlist))
+            for i, word in enumerate(words):
+                self.assertEqual(vocabulary[word], str(i))
+            self.assertNotIn("wisdom", vocabulary)
+            self.assertEqual(vocabulary.ids(["of", "wisdom"]).tolist(), [1, -1])
+            vocabulary.close()
+
+    def test_cached_tokens_encode_identically(self):
+        tokenizer = Tokenizer(sample)
+        dictionary = dict()
+        for word in tokenizer.tokenize():
+            if word not in dictionary and word != "worst":
+                dictionary[word] = str(len(dictionary))
+        batch = tokenBatches(["unigrams", "bigrams"])
+        batch.dictionary = dictionary
+        with tempfile.TemporaryDirectory() as dir:
+            writer = TokenCacheWriter(dir, 0)
+            writer.add("dickens", Tokenizer(sample).tokenize())
+            writer.add("empty", Tokenizer("").tokenize())
+            writer.close()
+            segment = os.path.join(dir, cache_segments(dir)[0])
+            cached = list(read_segment(segment, dictionary))
+        self.assertEqual([filename for filename, _ in cached], ["dickens", "empty"])
+        for level in ["unigrams", "bigrams"]:
+            expected = batch.encodeCounts(7, tokenizer.counts(level))
+            grams, counts = cached[0][1].wordid_counts(level)
+            self.assertEqual(sorted(batch.formatIdCounts(7, grams, counts)), sorted(expected))
+
+if __name__=="__main__":
+    unittest.main()